@@ -392,7 +392,7 @@ class Generator(DataGeneratorBase):
 
         # Rotate coordinates
         r_xyz = tf.matmul(xyz, tf.transpose(i_rotation_matrix, perm=[0, 2, 1]))
-        r_zyx = tf.stack([r_xyz[..., 2], r_xyz[..., 1], r_xyz[..., 0]], axis=-1)
+        r_zyx = tf.reverse(r_xyz, axis=[-1])
 
         # Interpolate values
         kernel_3d = tf.reshape(trilinear_interpolation(kernel_3d[..., None], r_zyx),
@@ -491,15 +491,22 @@ class Generator(DataGeneratorBase):
         return tf.reshape(w_images, [batch_size_scope, self.xsize, self.xsize, 1])
 
     def resizeImageFourier(self, images, out_size):
+        return self.ifftResizeImage(self.fftResizeImage(images), out_size)
+
+    def fftResizeImage(self, images):
         images = tf.cast(images, tf.float32)
 
         # Sizes
         xsize = tf.shape(images)[1]
         pad_size = self.pad_factor * xsize
-        pad_out_size = self.pad_factor * out_size
 
-        # Fourier transform
-        ft_images = full_fft_pad(images, pad_size, pad_size)
+        # Fourier transform (can be shared by several resizings of the same images)
+        return full_fft_pad(images, pad_size, pad_size)
+
+    def ifftResizeImage(self, ft_images, out_size):
+        # Sizes
+        pad_size = tf.shape(ft_images)[1]
+        pad_out_size = self.pad_factor * out_size
 
         # Normalization constant
         norm = tf.cast(pad_out_size, dtype=tf.float32) / tf.cast(pad_size, dtype=tf.float32)
@@ -168,23 +168,26 @@ class Generator(DataGeneratorBase):
         c_x_2d = self.applyShifts(self.scale_factor * c[0][0], c[1], 0)
         c_y_2d = self.applyShifts(self.scale_factor * c[0][1], c[1], 1)
 
-        c_x_2d = c_x_2d[:, :, None]
-        c_y_2d = c_y_2d[:, :, None]
-        c_sampling = tf.concat([c_y_2d, c_x_2d], axis=2)
-
-        imgs = tf.zeros((batch_size_scope, self.xsize, self.xsize), dtype=tf.float32)
+        c_sampling = tf.stack([c_y_2d, c_x_2d], axis=2)
 
         bamp = self.values[None, :] + c[2]
 
         bposf = tf.round(c_sampling)
         bposi = tf.cast(bposf, tf.int32)
 
-        num = tf.reduce_sum(((bposf - c_sampling) ** 2.), axis=-1)
-        sigma = 1.
-        bamp = bamp * tf.exp(-num / (2. * sigma ** 2.))
+        num = tf.reduce_sum(tf.math.squared_difference(bposf, c_sampling), axis=-1)
+        bamp = bamp * tf.exp(-0.5 * num)  # sigma = 1
+
+        # Flat pixel ids of the whole batch (coordinates outside the images are zeroed out so they
+        # cannot leak into the neighbouring image)
+        inside = tf.reduce_all(tf.logical_and(bposi >= 0, bposi < self.xsize), axis=-1)
+        b_offset = tf.range(batch_size_scope)[:, None] * (self.xsize * self.xsize)
+        gidx = b_offset + bposi[..., 0] * self.xsize + bposi[..., 1]
+        gidx = tf.where(inside, gidx, tf.zeros_like(gidx))
+        bamp = tf.where(inside, bamp, tf.zeros_like(bamp))
 
-        fn = lambda inp: tf.tensor_scatter_nd_add(inp[0], inp[1], inp[2])
-        imgs = tf.map_fn(fn, [imgs, bposi, bamp], fn_output_signature=tf.float32)
+        imgs = tf.scatter_nd(tf.reshape(gidx, [-1, 1]), tf.reshape(bamp, [-1]),
+                             [batch_size_scope * self.xsize * self.xsize])
 
         imgs = tf.reshape(imgs, [-1, self.xsize, self.xsize, 1])
 
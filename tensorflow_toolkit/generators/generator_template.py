@@ -311,7 +311,7 @@ class DataGeneratorBase:
             if self.shuffle:
                 dataset = dataset.shuffle(len(file_idx))
             # dataset = dataset.map(lambda image, label: (self.data_augmentation(image), label))
-            return dataset.batch(self.batch_size).prefetch(2)
+            return dataset.batch(self.batch_size).prefetch(tf.data.AUTOTUNE)
 
     # ----- -------- -----#
 
@@ -343,19 +343,21 @@ class DataGeneratorBase:
         w_images = ifft_pad(ft_w_images, size, size)
         return tf.reshape(w_images, [batch_size_scope, self.xsize, self.xsize, 1])
 
-    def ctfFilterImage(self, images):
+    def ctfFilterImage(self, images, ctf=None):
         # Get current batch size (function scope)
         batch_size_scope = tf.shape(images)[0]
 
+        # Batch CTF (unless a different one is provided, which can already be cast to complex
+        # so it is not cast again on every call)
+        ctf = self.ctf if ctf is None else ctf
+
         # Sizes
         pad_size = tf.constant(int(self.pad_factor * self.xsize), dtype=tf.int32)
         size = tf.constant(int(self.xsize), dtype=tf.int32)
 
         # ft_images = tf.signal.fftshift(tf.signal.rfft2d(images[:, :, :, 0]))
         ft_images = fft_pad(images, pad_size, pad_size)
-        ft_ctf_images_real = tf.multiply(tf.math.real(ft_images), self.ctf)
-        ft_ctf_images_imag = tf.multiply(tf.math.imag(ft_images), self.ctf)
-        ft_ctf_images = tf.complex(ft_ctf_images_real, ft_ctf_images_imag)
+        ft_ctf_images = ft_images * tf.cast(ctf, ft_images.dtype)
         # ctf_images = tf.signal.irfft2d(tf.signal.ifftshift(ft_ctf_images))
         ctf_images = ifft_pad(ft_ctf_images, size, size)
         return tf.reshape(ctf_images, [batch_size_scope, self.xsize, self.xsize, 1])
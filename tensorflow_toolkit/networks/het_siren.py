@@ -29,192 +29,280 @@ import tensorflow as tf
 from tensorflow.keras import layers, models, Input, Model
 
 from pathlib import Path
+from types import SimpleNamespace
 import numpy as np
-from scipy.ndimage import gaussian_filter
-from scipy import signal
 from xmipp_metadata.image_handler import ImageHandler
 from xmipp_metadata.metadata import XmippMetaData
 
+try:
+    from numba import njit, prange
+
+    allow_numba = True
+except ImportError:
+    allow_numba = False
+
 from tensorflow_toolkit.utils import computeCTF, full_fft_pad, full_ifft_pad, create_blur_filters, \
     apply_blur_filters_to_batch
 from tensorflow_toolkit.layers.siren import SIRENFirstLayerInitializer, SIRENInitializer, MetaDenseWrapper, Sine
 
 
 ##### Extra functions for HetSIREN network #####
-def richardsonLucyDeconvolver(volume, iter=5):
-    original_volume = volume.copy()
-    volume = tf.constant(volume, dtype=tf.float32)
-    original_volume = tf.constant(original_volume, dtype=tf.float32)
-
-    std = np.pi * np.sqrt(volume.shape[1])
-    gauss_1d = signal.windows.gaussian(volume.shape[1], std)
-    kernel = np.einsum('i,j,k->ijk', gauss_1d, gauss_1d, gauss_1d)
-    kernel = tf.constant(kernel, dtype=tf.float32)
-
-    def applyKernelFourier(x):
-        x = tf.cast(x, dtype=tf.complex64)
-        ft_x = tf.signal.fftshift(tf.signal.fft3d(x))
-        ft_x_real = tf.math.real(ft_x) * kernel
-        ft_x_imag = tf.math.imag(ft_x) * kernel
-        ft_x = tf.complex(ft_x_real, ft_x_imag)
-        return tf.math.real(tf.signal.ifft3d(tf.signal.fftshift(ft_x)))
-
-    for _ in range(iter):
+def centeredFilterToRfft(filter_1d):
+    """
+    Builds the half-spectrum (rfft3d layout) of a separable real Fourier filter from its 1D profile
+    defined on a centered (fftshifted) axis. The shift and the symmetrization needed to match the real
+    part of the full complex fft3d/ifft3d pipeline are done on the 1D profile, so the spectra of the
+    data never need to be shifted.
+
+    Parameters:
+    filter_1d (Tensor): Real Fourier filter profile of size N centered at N // 2
+
+    Returns:
+    Tensor: Real float32 filter of shape (N, N, N // 2 + 1)
+    """
+    size = filter_1d.shape[0]
+    filter_1d = tf.roll(tf.cast(filter_1d, dtype=tf.float32), shift=-(size // 2), axis=0)
+    filter_1d = 0.5 * (filter_1d + tf.roll(tf.reverse(filter_1d, axis=[0]), shift=1, axis=0))
+    filter_half = filter_1d[:size // 2 + 1]
+    return filter_1d[:, None, None] * filter_1d[None, :, None] * filter_half[None, None, :]
+
+
+def gaussianWindow(size, std):
+    """
+    Gaussian window of the given size centered at (size - 1) / 2 (same as scipy.signal.windows.gaussian),
+    built directly on device.
+
+    Parameters:
+    size (int): Number of samples
+    std (float): Standard deviation in samples
+
+    Returns:
+    Tensor: Float32 window of shape (size,)
+    """
+    n = tf.range(size, dtype=tf.float32) - 0.5 * (size - 1)
+    return tf.exp(-0.5 * tf.square(n / std))
+
+
+def fftDevice():
+    # FFTs are much faster on GPU, so deconvolution tensors are kept there when available
+    return '/GPU:0' if tf.config.list_physical_devices('GPU') else '/CPU:0'
+
+
+def kernelMagnitudeSpectrum(kernel):
+    """
+    Computes the magnitude of the half-spectrum (rfft3d layout) of a real space kernel. The magnitude
+    does not depend on the kernel position, so no fftshift is needed.
+
+    Parameters:
+    kernel (Tensor): Real space kernel of shape (N, N, N)
+
+    Returns:
+    Tensor: Real float32 spectrum of shape (N, N, N // 2 + 1)
+    """
+    return tf.abs(tf.signal.rfft3d(tf.cast(kernel, dtype=tf.float32)))
+
+
+def separableMagnitudeSpectrum(kernel_1d):
+    """
+    Computes the magnitude of the half-spectrum (rfft3d layout) of a separable real space kernel
+    k(z, y, x) = k1(z) * k1(y) * k1(x). The 3D spectrum is the outer product of the 1D spectra, so the
+    N^3 kernel is never built in real space.
+
+    Parameters:
+    kernel_1d (ndarray): Real space 1D kernel of size N
+
+    Returns:
+    Tensor: Real float32 spectrum of shape (N, N, N // 2 + 1)
+    """
+    kernel_1d = tf.cast(kernel_1d, dtype=tf.float32)
+    ft_1d = tf.abs(tf.signal.fft(tf.cast(kernel_1d, dtype=tf.complex64)))
+    ft_half = tf.abs(tf.signal.rfft(kernel_1d))
+    return ft_1d[:, None, None] * ft_1d[None, :, None] * ft_half[None, None, :]
+
+
+@tf.function
+def applyKernelFourier(x, ft_kernel):
+    """
+    Filters a volume (or a batch of volumes) with a real Fourier filter.
+
+    Parameters:
+    x (Tensor): Real volumes of shape (..., N, N, N)
+    ft_kernel (Tensor): Real filter in rfft3d layout of shape (N, N, N // 2 + 1)
+
+    Returns:
+    Tensor: Filtered volumes with the same shape as x
+    """
+    ft_x = tf.signal.rfft3d(tf.cast(x, dtype=tf.float32))
+    ft_x = ft_x * tf.cast(ft_kernel, dtype=tf.complex64)
+    return tf.signal.irfft3d(ft_x, fft_length=tf.shape(x)[-3:])
+
+
+@tf.function(jit_compile=True)
+def richardsonLucyIterations(volume, original_volume, kernel, iter):
+    def body(i, volume):
         # Deconvolve image (update)
-        conv_1 = applyKernelFourier(volume)
+        conv_1 = applyKernelFourier(volume, kernel)
         conv_1_2 = conv_1 * conv_1
-        epsilon = 0.1 * np.mean(conv_1_2[:])
+        epsilon = 0.1 * tf.reduce_mean(conv_1_2)
         update = original_volume * conv_1 / (conv_1_2 + epsilon)
-        update = applyKernelFourier(update)
+        update = applyKernelFourier(update, kernel)
         volume = volume * update
 
-        volume = volume.numpy()
+        # Soft thresholding
         thr = 1e-6
-        volume = volume - (volume > thr) * thr + (volume < -thr) * thr - (volume == thr) * volume
+        volume = tf.where(tf.abs(volume) > thr, volume - tf.sign(volume) * thr, tf.zeros_like(volume))
+
+        return i + 1, volume
+
+    _, volume = tf.while_loop(lambda i, _: i < iter, body, [tf.constant(0), volume])
+
+    return volume
+
+
+def richardsonLucyDeconvolver(volume, iter=5):
+    with tf.device(fftDevice()):
+        original_volume = volume.copy()
         volume = tf.constant(volume, dtype=tf.float32)
+        original_volume = tf.constant(original_volume, dtype=tf.float32)
+
+        std = np.pi * np.sqrt(volume.shape[1])
+        gauss_1d = gaussianWindow(volume.shape[1], std)
+        kernel = centeredFilterToRfft(gauss_1d)
+
+        # Iterations run on device as a single XLA compiled loop
+        volume = richardsonLucyIterations(volume, original_volume, kernel, tf.constant(iter))
 
     return volume.numpy()
 
 
 def richardsonLucyBlindDeconvolver(volume, global_iter=5, iter=20):
-    original_volume = volume.copy()
-    volume = tf.constant(volume, dtype=tf.float32)
-    original_volume = tf.constant(original_volume, dtype=tf.float32)
-
-    # Create a gaussian kernel that will be used to blur the original acquisition
-    std = 1.0
-    gauss_1d = signal.windows.gaussian(volume.shape[1], std)
-    kernel = np.einsum('i,j,k->ijk', gauss_1d, gauss_1d, gauss_1d)
-    kernel = tf.constant(kernel, dtype=tf.float32)
-
-    def applyKernelFourier(x, y):
-        x = tf.cast(x, dtype=tf.complex64)
-        y = tf.cast(y, dtype=tf.complex64)
-        ft_x = tf.signal.fftshift(tf.signal.fft3d(x))
-        ft_y = tf.abs(tf.signal.fftshift(tf.signal.fft3d(y)))
-        ft_x_real = tf.math.real(ft_x) * ft_y
-        ft_x_imag = tf.math.imag(ft_x) * ft_y
-        ft_x = tf.complex(ft_x_real, ft_x_imag)
-        return tf.math.real(tf.signal.ifft3d(tf.signal.fftshift(ft_x)))
-
-    for _ in range(global_iter):
-        for _ in range(iter):
-            # Deconvolve image (update)
-            conv_1 = applyKernelFourier(volume, kernel)
-            conv_1_2 = conv_1 * conv_1
-            epsilon = 1e-6 * tf.reduce_mean(conv_1_2)
-            update = original_volume * conv_1 / (conv_1_2 + epsilon)
-            update = applyKernelFourier(update, tf.reverse(kernel, axis=[0, 1, 2]))
-            volume = volume * update
-
-            # volume = volume.numpy()
-            # thr = 1e-6
-            # volume = volume - (volume > thr) * thr + (volume < -thr) * thr - (volume == thr) * volume
-            # volume = tf.constant(volume, dtype=tf.float32)
-
-        for _ in range(iter):
-            # Update kernel
-            conv_1 = applyKernelFourier(kernel, volume)
-            conv_1_2 = conv_1 * conv_1
-            epsilon = 1e-6 * tf.reduce_mean(conv_1_2)
-            update = original_volume * conv_1 / (conv_1_2 + epsilon)
-            update = applyKernelFourier(update, tf.reverse(volume, axis=[0, 1, 2]))
-            kernel = kernel * update
-
-            # kernel = kernel.numpy()
-            # thr = 1e-6
-            # kernel = kernel - (kernel > thr) * thr + (kernel < -thr) * thr - (kernel == thr) * kernel
-            # kernel = tf.constant(kernel, dtype=tf.float32)
-
-    return volume
+    with tf.device(fftDevice()):
+        original_volume = tf.constant(volume, dtype=tf.float32)
+
+        # Volume and kernel are updated in place to avoid a new allocation per iteration
+        volume = tf.Variable(original_volume, trainable=False)
+
+        # Create a gaussian kernel that will be used to blur the original acquisition
+        std = 1.0
+        gauss_1d = gaussianWindow(volume.shape[1], std)
+        kernel = gauss_1d[:, None, None] * gauss_1d[None, :, None] * gauss_1d[None, None, :]
+        kernel = tf.Variable(kernel, dtype=tf.float32, trainable=False)
+
+        for _ in range(global_iter):
+            # Kernel is fixed while the volume is updated. The spectrum of a flipped real kernel is the conjugate
+            # of the original one, so its magnitude (used for the adjoint step) is the same
+            ft_kernel = kernelMagnitudeSpectrum(kernel)
+
+            for _ in range(iter):
+                # Deconvolve image (update)
+                conv_1 = applyKernelFourier(volume, ft_kernel)
+                conv_1_2 = conv_1 * conv_1
+                epsilon = 1e-6 * tf.reduce_mean(conv_1_2)
+                update = original_volume * conv_1 / (conv_1_2 + epsilon)
+                update = applyKernelFourier(update, ft_kernel)
+                volume.assign_mul(update)
+
+                # volume = volume.numpy()
+                # thr = 1e-6
+                # volume = volume - (volume > thr) * thr + (volume < -thr) * thr - (volume == thr) * volume
+                # volume = tf.constant(volume, dtype=tf.float32)
+
+            # Volume is fixed while the kernel is updated
+            ft_volume = kernelMagnitudeSpectrum(volume)
+
+            for _ in range(iter):
+                # Update kernel
+                conv_1 = applyKernelFourier(kernel, ft_volume)
+                conv_1_2 = conv_1 * conv_1
+                epsilon = 1e-6 * tf.reduce_mean(conv_1_2)
+                update = original_volume * conv_1 / (conv_1_2 + epsilon)
+                update = applyKernelFourier(update, ft_volume)
+                kernel.assign_mul(update)
+
+                # kernel = kernel.numpy()
+                # thr = 1e-6
+                # kernel = kernel - (kernel > thr) * thr + (kernel < -thr) * thr - (kernel == thr) * kernel
+                # kernel = tf.constant(kernel, dtype=tf.float32)
+
+    return volume.read_value()
 
 
 def deconvolveTV(volume, iterations, regularization_weight, lr=0.01):
-    original = tf.Variable(volume, dtype=tf.float32)
-
-    # Create a gaussian kernel that will be used to blur the original acquisition
-    std = 1.0
-    gauss_1d = signal.windows.gaussian(volume.shape[1], std)
-    psf = np.einsum('i,j,k->ijk', gauss_1d, gauss_1d, gauss_1d)
-    psf = tf.constant(psf, dtype=tf.float32)
-
-    def applyKernelFourier(x, y):
-        x = tf.cast(x, dtype=tf.complex64)
-        y = tf.cast(y, dtype=tf.complex64)
-        ft_x = tf.signal.fftshift(tf.signal.fft3d(x))
-        ft_y = tf.abs(tf.signal.fftshift(tf.signal.fft3d(y)))
-        ft_x_real = tf.math.real(ft_x) * ft_y
-        ft_x_imag = tf.math.imag(ft_x) * ft_y
-        ft_x = tf.complex(ft_x_real, ft_x_imag)
-        return tf.math.real(tf.signal.ifft3d(tf.signal.fftshift(ft_x)))
-
-    for i in range(iterations):
-        with tf.GradientTape() as tape:
-            # Convolve with PSF
-            # convolved = tf.nn.conv2d(tf.expand_dims(original, axis=0), tf.expand_dims(psf, axis=0), strides=[1, 1, 1, 1], padding='SAME')
-            # convolved = tf.squeeze(convolved)
-            convolved = applyKernelFourier(volume, psf)
-
-            # Calculate the loss (data fidelity term + TV regularization)
-            loss = tf.reduce_mean(tf.square(convolved - volume)) + regularization_weight * tf.reduce_sum(
-                tf.image.total_variation(original))
-
-        # Perform a gradient descent step
-        grads = tape.gradient(loss, [original])
-        # grads = tf.gradients(loss, [original])
-        original.assign_sub(lr * grads[0])
+    with tf.device(fftDevice()):
+        original = tf.Variable(volume, dtype=tf.float32)
+
+        # Create a gaussian kernel that will be used to blur the original acquisition
+        std = 1.0
+        gauss_1d = gaussianWindow(volume.shape[1], std)
+        ft_psf = separableMagnitudeSpectrum(gauss_1d)
+
+        for i in range(iterations):
+            with tf.GradientTape() as tape:
+                # Convolve with PSF
+                # convolved = tf.nn.conv2d(tf.expand_dims(original, axis=0), tf.expand_dims(psf, axis=0), strides=[1, 1, 1, 1], padding='SAME')
+                # convolved = tf.squeeze(convolved)
+                convolved = applyKernelFourier(volume, ft_psf)
+
+                # Calculate the loss (data fidelity term + TV regularization)
+                loss = tf.reduce_mean(tf.square(convolved - volume)) + regularization_weight * \
+                       total_variation_3d(original)
+
+            # Perform a gradient descent step
+            grads = tape.gradient(loss, [original])
+            # grads = tf.gradients(loss, [original])
+            original.assign_sub(lr * grads[0])
 
     return original.numpy()
 
 
 def tv_deconvolution_bregman(volume, iterations, regularization_weight, lr=0.01):
-    deconvolved = tf.Variable(volume, dtype=tf.float32)
-    bregman = tf.Variable(tf.zeros_like(volume), dtype=tf.float32)
-
-    # Create a gaussian kernel that will be used to blur the original acquisition
-    std = 1.0
-    gauss_1d = signal.windows.gaussian(volume.shape[1], std)
-    psf = np.einsum('i,j,k->ijk', gauss_1d, gauss_1d, gauss_1d)
-    psf_tf = tf.constant(psf, dtype=tf.float32)
-
-    # psf_mirror = tf.reverse(tf.reverse(psf_tf, axis=[0]), axis=[1])
-
-    def applyKernelFourier(x, y):
-        x = tf.cast(x, dtype=tf.complex64)
-        y = tf.cast(y, dtype=tf.complex64)
-        ft_x = tf.signal.fftshift(tf.signal.fft3d(x))
-        ft_y = tf.abs(tf.signal.fftshift(tf.signal.fft3d(y)))
-        ft_x_real = tf.math.real(ft_x) * ft_y
-        ft_x_imag = tf.math.imag(ft_x) * ft_y
-        ft_x = tf.complex(ft_x_real, ft_x_imag)
-        return tf.math.real(tf.signal.ifft3d(tf.signal.fftshift(ft_x)))
-
-    for i in range(iterations):
-        with tf.GradientTape() as tape:
-            # Convolve with PSF
-            # convolved = tf.nn.conv2d(tf.expand_dims(original, axis=0), tf.expand_dims(psf, axis=0), strides=[1, 1, 1, 1], padding='SAME')
-            # convolved = tf.squeeze(convolved)
-            convolved = applyKernelFourier(volume, psf)
+    with tf.device(fftDevice()):
+        deconvolved = tf.Variable(volume, dtype=tf.float32)
+        bregman = tf.Variable(tf.zeros_like(volume), dtype=tf.float32)
+
+        # Create a gaussian kernel that will be used to blur the original acquisition
+        std = 1.0
+        gauss_1d = gaussianWindow(volume.shape[1], std)
+        ft_psf = separableMagnitudeSpectrum(gauss_1d)
+
+        for i in range(iterations):
+            with tf.GradientTape() as tape:
+                # Convolve with PSF
+                # convolved = tf.nn.conv2d(tf.expand_dims(original, axis=0), tf.expand_dims(psf, axis=0), strides=[1, 1, 1, 1], padding='SAME')
+                # convolved = tf.squeeze(convolved)
+                convolved = applyKernelFourier(volume, ft_psf)
+
+                # Calculate the loss (data fidelity term + TV regularization)
+                loss = tf.reduce_mean(tf.square(convolved - volume)) + regularization_weight * \
+                       total_variation_3d(deconvolved - bregman)
+
+            # Perform a gradient descent step
+            grads = tape.gradient(loss, [deconvolved])
+            # grads = tf.gradients(loss, [deconvolved])
+            deconvolved.assign_sub(lr * grads[0])
+
+            # Bregman Update
+            bregman.assign(bregman + deconvolved - tv_minimization_step(deconvolved, lr))
 
-            # Calculate the loss (data fidelity term + TV regularization)
-            loss = tf.reduce_mean(tf.square(convolved - volume)) + regularization_weight * tf.reduce_sum(
-                tf.image.total_variation(deconvolved - bregman))
+    return deconvolved.numpy()
 
-        # Perform a gradient descent step
-        grads = tape.gradient(loss, [deconvolved])
-        # grads = tf.gradients(loss, [deconvolved])
-        deconvolved.assign_sub(lr * grads[0])
 
-        # Bregman Update
-        bregman.assign(bregman + deconvolved - tv_minimization_step(deconvolved, lr))
-
-    return deconvolved.numpy()
+def total_variation_3d(volume):
+    # Anisotropic TV of a (N, N, N) volume (tf.image.total_variation only works on 2D images)
+    return tf.reduce_sum(tf.abs(volume[1:, :, :] - volume[:-1, :, :])) + \
+           tf.reduce_sum(tf.abs(volume[:, 1:, :] - volume[:, :-1, :])) + \
+           tf.reduce_sum(tf.abs(volume[:, :, 1:] - volume[:, :, :-1]))
 
 
 def tv_minimization_step(image, lr):
-    # Implement the TV minimization step
-    # This is a placeholder function, in practice, you'll need a proper implementation
-    return image - lr * tf.image.total_variation(image)
+    # Subgradient descent step on the 3D TV: each voxel gets sign(v_i - v_i-1) - sign(v_i+1 - v_i) along every axis
+    sign_z = tf.sign(image[1:, :, :] - image[:-1, :, :])
+    sign_y = tf.sign(image[:, 1:, :] - image[:, :-1, :])
+    sign_x = tf.sign(image[:, :, 1:] - image[:, :, :-1])
+    grad = tf.pad(sign_z, [[1, 0], [0, 0], [0, 0]]) - tf.pad(sign_z, [[0, 1], [0, 0], [0, 0]]) + \
+           tf.pad(sign_y, [[0, 0], [1, 0], [0, 0]]) - tf.pad(sign_y, [[0, 0], [0, 1], [0, 0]]) + \
+           tf.pad(sign_x, [[0, 0], [0, 0], [1, 0]]) - tf.pad(sign_x, [[0, 0], [0, 0], [0, 1]])
+    return image - lr * grad
 
 
 ### Image smoothness with TV ###
@@ -282,13 +370,14 @@ def mse_smoothness_loss(volume, diff1, diff2, diff3, precision, precision_scaled
 
 def densitySmoothnessVolume(xsize, indices, values, precision, precision_scaled=tf.float32):
     B = tf.shape(values)[0]
+    indices = tf.cast(indices, dtype=tf.int32)
+    M = tf.shape(indices)[0]
 
-    grid = tf.zeros((B, xsize, xsize, xsize), dtype=precision)
-    indices = tf.tile(tf.cast(indices[None, ...], dtype=tf.int32), (B, 1, 1))
-
-    # Scatter in volumes
-    fn = lambda inp: tf.tensor_scatter_nd_add(inp[0], inp[1], inp[2])
-    grid = tf.map_fn(fn, [grid, indices, values], fn_output_signature=precision)
+    # Scatter in volumes (batch index prepended to scatter the whole batch at once)
+    batch_indices = tf.repeat(tf.range(B)[:, None], M, axis=1)[..., None]
+    indices = tf.concat([batch_indices, tf.broadcast_to(indices[None, ...], (B, M, 3))], axis=-1)
+    grid = tf.scatter_nd(tf.reshape(indices, [-1, 4]), tf.reshape(tf.cast(values, precision), [-1]),
+                         (B, xsize, xsize, xsize))
 
     # Calculate the differences of neighboring pixel-values.
     # The total variation loss is the sum of absolute differences of neighboring pixels
@@ -301,40 +390,40 @@ def densitySmoothnessVolume(xsize, indices, values, precision, precision_scaled=
     return (total_variation_loss(grid, pixel_diff1, pixel_diff2, pixel_diff3, precision, precision_scaled),
             mse_smoothness_loss(grid, pixel_diff1, pixel_diff2, pixel_diff3, precision, precision_scaled))
 
+_FILTER_KERNEL_CACHE = {}
+
+
 def filterVol(volume):
-    size = volume.shape[1]
-    volume = tf.constant(volume, dtype=tf.float32)
-
-    b_spline_1d = np.asarray([0.0, 0.5, 1.0, 0.5, 0.0])
-
-    pad_before = (size - len(b_spline_1d)) // 2
-    pad_after = size - pad_before - len(b_spline_1d)
-
-    kernel = np.einsum('i,j,k->ijk', b_spline_1d, b_spline_1d, b_spline_1d)
-    kernel = np.pad(kernel, (pad_before, pad_after), 'constant', constant_values=(0.0,))
-    kernel = tf.constant(kernel, dtype=tf.complex64)
-    ft_kernel = tf.abs(tf.signal.fftshift(tf.signal.fft3d(kernel)))
-
-    # Create a gaussian kernel that will be used to blur the original acquisition
-    # std = 2.0
-    # gauss_1d = signal.windows.gaussian(volume.shape[1], std)
-    # kernel = np.einsum('i,j,k->ijk', gauss_1d, gauss_1d, gauss_1d)
-    # kernel = tf.constant(kernel, dtype=tf.complex64)
-    # ft_kernel = tf.abs(tf.signal.fftshift(tf.signal.fft3d(kernel)))
-
-    def applyKernelFourier(x):
-        x = tf.cast(x, dtype=tf.complex64)
-        ft_x = tf.signal.fftshift(tf.signal.fft3d(x))
-        ft_x_real = tf.math.real(ft_x) * ft_kernel
-        ft_x_imag = tf.math.imag(ft_x) * ft_kernel
-        ft_x = tf.complex(ft_x_real, ft_x_imag)
-        return tf.math.real(tf.signal.ifft3d(tf.signal.fftshift(ft_x)))
-
-    volume = applyKernelFourier(volume).numpy()
-    thr = 1e-6
-    volume = volume - (volume > thr) * thr + (volume < -thr) * thr - (volume == thr) * volume
+    # Volume can be a single (N, N, N) map or a batch of maps (B, N, N, N)
+    with tf.device(fftDevice()):
+        size = volume.shape[-1]
+        volume = tf.cast(volume, dtype=tf.float32)
 
-    return volume
+        # The filter only depends on the box size, so it is built once per size
+        if size not in _FILTER_KERNEL_CACHE:
+            b_spline_1d = np.asarray([0.0, 0.5, 1.0, 0.5, 0.0])
+
+            pad_before = (size - len(b_spline_1d)) // 2
+            pad_after = size - pad_before - len(b_spline_1d)
+
+            kernel = np.pad(b_spline_1d, (pad_before, pad_after), 'constant', constant_values=(0.0,))
+            _FILTER_KERNEL_CACHE[size] = separableMagnitudeSpectrum(kernel)
+        ft_kernel = _FILTER_KERNEL_CACHE[size]
+
+        # Create a gaussian kernel that will be used to blur the original acquisition
+        # std = 2.0
+        # gauss_1d = gaussianWindow(volume.shape[1], std)
+        # kernel = np.einsum('i,j,k->ijk', gauss_1d, gauss_1d, gauss_1d)
+        # kernel = tf.constant(kernel, dtype=tf.complex64)
+        # ft_kernel = tf.abs(tf.signal.fftshift(tf.signal.fft3d(kernel)))
+
+        volume = applyKernelFourier(volume, ft_kernel)
+
+        # Soft thresholding
+        thr = 1e-6
+        volume = tf.where(tf.abs(volume) > thr, volume - tf.sign(volume) * thr, tf.zeros_like(volume))
+
+    return volume.numpy()
 
 
 def resizeImageFourier(images, out_size, pad_factor=1):
@@ -383,6 +472,22 @@ def normalize_to_other_volumes(batch1, batch2):
     return normalized_batch2
 
 
+if allow_numba:
+    @njit(parallel=True, fastmath=True)
+    def matchHistogramsNumba(s_values, r_values, matched):
+        B, M = s_values.shape
+        for b in prange(B):
+            s_order = np.argsort(s_values[b])
+            r_sorted = np.sort(r_values[b])
+
+            # Walk the source backwards so tied values share the rank of the last element of their group
+            last = M - 1
+            for i in range(M - 1, -1, -1):
+                if i < M - 1 and s_values[b, s_order[i]] != s_values[b, s_order[i + 1]]:
+                    last = i
+                matched[b, s_order[i]] = r_sorted[last]
+
+
 def match_histograms(source, reference):
     """
     Adjust the pixel values of a N-D source volume to match the histogram of a reference volume.
@@ -397,30 +502,37 @@ def match_histograms(source, reference):
     - matched: ndarray
       The source volume after histogram matching.
     """
-    matched = np.zeros_like(source)
+    B = source.shape[0]
+
+    # Flatten the volumes
+    s_values = source.reshape(B, -1)
+    M = s_values.shape[1]
+
+    # Parallel (per volume) compiled version if Numba is available
+    if allow_numba:
+        matched = np.empty_like(s_values)
+        matchHistogramsNumba(np.ascontiguousarray(s_values), np.ascontiguousarray(reference.reshape(B, -1)),
+                             matched)
+        return matched.reshape(source.shape)
 
-    for b in range(source.shape[0]):
-        # Flatten the volumes
-        s_values = source[b].ravel()
-        r_values = reference[b].ravel()
+    r_values = np.sort(reference.reshape(B, -1), axis=1)
 
-        # Get unique values and their corresponding indices for both source and reference
-        s_values_unique, s_inverse = np.unique(s_values, return_inverse=True)
-        r_values_unique, r_counts = np.unique(r_values, return_counts=True)
+    # Sort the source to get the rank of each voxel
+    s_order = np.argsort(s_values, axis=1, kind="stable")
+    s_sorted = np.take_along_axis(s_values, s_order, axis=1)
 
-        # Calculate the CDF for the source and reference
-        s_quantiles = np.cumsum(np.bincount(s_inverse, minlength=s_values_unique.size))
-        s_quantiles = s_quantiles / s_quantiles[-1]
-        r_quantiles = np.cumsum(r_counts)
-        r_quantiles = r_quantiles / r_quantiles[-1]
+    # Tied source values share the quantile of the last element of their group
+    is_last = np.ones((B, M), dtype=bool)
+    is_last[:, :-1] = s_sorted[:, 1:] != s_sorted[:, :-1]
+    last_idx = np.where(is_last, np.arange(M)[None, :], M - 1)
+    last_idx = np.minimum.accumulate(last_idx[:, ::-1], axis=1)[:, ::-1]
 
-        # Interpolate
-        interp_r_values = np.interp(s_quantiles, r_quantiles, r_values_unique)
+    # Map the source pixels to the reference pixels with the same quantile
+    matched = np.empty_like(s_values)
+    np.put_along_axis(matched, s_order, np.take_along_axis(r_values, last_idx, axis=1), axis=1)
 
-        # Map the source pixels to the reference pixels
-        matched[b] = interp_r_values[s_inverse].reshape(source[b].shape)
+    return matched.reshape(source.shape)
 
-    return matched
 
 def compute_histogram(tensor, bins=10, minval=None, maxval=None):
     """Computes histograms for each row in a batched tensor.
@@ -509,7 +621,6 @@ class Encoder(Model):
             b3_out = tf.keras.layers.Conv2D(16, 3, activation="relu", strides=(2, 2), padding="same")(b3_add)
             x = tf.keras.layers.Flatten()(b3_out)
 
-            x = layers.Flatten()(x)
             for _ in range(4):
                 x = layers.Dense(256, activation='relu')(x)
 
@@ -545,7 +656,6 @@ class Encoder(Model):
             b3_out = tf.keras.layers.Conv2D(512, 3, activation="relu", strides=(2, 2), padding="same")(b3_add)
             x = tf.keras.layers.Flatten()(b3_out)
 
-            x = layers.Flatten()(x)
             x = layers.Dense(512, activation='relu')(x)
             for _ in range(4):
                 aux = layers.Dense(512, activation='relu')(x)
@@ -651,10 +761,13 @@ class Decoder(Model):
         self.decode_het = Model(latent, delta_het, name="decoder_het")
         self.decoder = Model([rows, shifts, latent], [decoded_het, decoded_het_ctf, delta_het], name="decoder")
 
+        # XLA compiled forward pass for volume evaluation (inference only)
+        self.decode_het_inference = tf.function(jit_compile=True)(self.decode_het)
+
     def eval_volume_het(self, x_het, filter=True, only_pos=False):
         batch_size = x_het.shape[0]
 
-        delta_het = self.decode_het(x_het)
+        delta_het = tf.cast(self.decode_het_inference(tf.cast(x_het, tf.float32)), tf.float32)
 
         # Update values within mask
         if self.generator.isFocused:
@@ -665,37 +778,37 @@ class Decoder(Model):
         else:
             updates = delta_het
 
-        values = tf.tile(self.generator.values[None, :], [batch_size, 1]) + updates
+        values = tf.tile(tf.cast(self.generator.values, tf.float32)[None, :], [batch_size, 1]) + updates
 
-        # Coords indices
-        o_z, o_y, o_x = (self.generator.full_indices[:, 0].astype(int), self.generator.full_indices[:, 1].astype(int),
-                         self.generator.full_indices[:, 2].astype(int))
+        # Coords indices (batch index prepended so all the volumes are scattered at once)
+        indices = tf.constant(self.generator.full_indices, dtype=tf.int32)
+        num_indices = tf.shape(indices)[0]
+        batch_indices = tf.repeat(tf.range(batch_size)[:, None], num_indices, axis=1)[..., None]
+        indices = tf.concat([batch_indices, tf.broadcast_to(indices[None, ...], (batch_size, num_indices, 3))],
+                            axis=-1)
 
-        # Get numpy volumes
-        values = values.numpy()
-        volume_grids = np.zeros((batch_size, self.generator.xsize, self.generator.xsize, self.generator.xsize),
-                                dtype=np.float32)
-        for idx in range(batch_size):
-            volume_grids[idx, o_z, o_y, o_x] = values[idx]
-            if filter:
-                volume_grids[idx] = filterVol(volume_grids[idx])
+        # Get volumes
+        xsize = self.generator.xsize
+        volume_grids = tf.scatter_nd(indices, tf.cast(values, tf.float32), [batch_size, xsize, xsize, xsize])
 
-            # Only for deconvolvers
-            if not only_pos:
-                neg_part = volume_grids[idx] * (volume_grids[idx] < 0.0)
-            volume_grids[idx] = volume_grids[idx] * (volume_grids[idx] >= 0.0)
+        # Filter the whole batch at once (batched FFT)
+        if filter:
+            volume_grids = filterVol(volume_grids)
 
-            # Deconvolvers
-            # volume_grids[idx] = richardsonLucyDeconvolver(volume_grids[idx])
-            # volume_grids[idx] = richardsonLucyBlindDeconvolver(volume_grids[idx], global_iter=5, iter=5)
-            # volume_grids[idx] = deconvolveTV(volume_grids[idx], iterations=50, regularization_weight=0.001, lr=0.01)
-            # volume_grids[idx] = tv_deconvolution_bregman(volume_grids[idx], iterations=50,
-            #                                              regularization_weight=0.1, lr=0.01)
+        # Deconvolvers (work on the positive part of a single volume, the negative part is added back afterwards)
+        # pos_part = tf.nn.relu(volume_grids)
+        # neg_part = volume_grids - pos_part
+        # pos_part = richardsonLucyDeconvolver(pos_part)
+        # pos_part = richardsonLucyBlindDeconvolver(pos_part, global_iter=5, iter=5)
+        # pos_part = deconvolveTV(pos_part, iterations=50, regularization_weight=0.001, lr=0.01)
+        # pos_part = tv_deconvolution_bregman(pos_part, iterations=50, regularization_weight=0.1, lr=0.01)
+        # volume_grids = pos_part + neg_part
 
-            if not only_pos:
-                volume_grids[idx] += neg_part
+        # Without deconvolution the split is only needed to drop the negative part
+        if only_pos:
+            volume_grids = tf.nn.relu(volume_grids)
 
-        return volume_grids.astype(np.float32)
+        return volume_grids.numpy().astype(np.float32)
 
     def call(self, x):
         decoded = self.decoder(x)
@@ -706,7 +819,7 @@ class AutoEncoder(Model):
     def __init__(self, generator, het_dim=10, architecture="convnn", CTF="wiener", refPose=True,
                  l1_lambda=0.5, tv_lambda=0.5, mse_lambda=0.5, mode=None, train_size=None, only_pos=True,
                  multires_levels=None, poseReg=0.0, ctfReg=0.0, precision=tf.float32, precision_scaled=tf.float32,
-                 use_hyper_network=True, **kwargs):
+                 use_hyper_network=True, grad_accum_steps=1, **kwargs):
         super(AutoEncoder, self).__init__(**kwargs)
         self.precision = precision
         self.precision_scaled = precision_scaled
@@ -747,6 +860,15 @@ class AutoEncoder(Model):
         self.disantangle_pose = poseReg > 0.0
         self.disantangle_ctf = ctfReg > 0.0
         self.isFocused = generator.isFocused
+        self.batch_params = tf.stack([generator.angle_rot, generator.angle_tilt, generator.angle_psi,
+                                      generator.shift_x, generator.shift_y, generator.defocusU,
+                                      generator.defocusV, generator.defocusAngle, generator.cs], axis=1)
+        self.prepare_batch = tf.function(jit_compile=True)(self.prepare_batch)
+        self.encode_inference = tf.function(self.encode, input_signature=[
+            tf.TensorSpec([None, self.xsize, self.xsize, 1], tf.float32)])
+        self.values_bcast = tf.convert_to_tensor(generator.values)[None, :]
+        self.grad_accum_steps = grad_accum_steps
+        self.grad_accum = None
         self.total_loss_tracker = tf.keras.metrics.Mean(name="total_loss")
         self.test_loss_tracker = tf.keras.metrics.Mean(name="test_loss")
         self.loss_het_tracker = tf.keras.metrics.Mean(name="rec_het")
@@ -763,6 +885,102 @@ class AutoEncoder(Model):
             self.loss_hist_tracker,
         ]
 
+    def prepare_batch(self, indexes, batch_size_scope):
+        # Gather all the alignment and CTF parameters of the batch at once
+        batch_params = tf.unstack(tf.gather(self.batch_params, indexes, axis=0), axis=1)
+        rot_batch, tilt_batch, psi_batch, shift_x_batch, shift_y_batch = batch_params[:5]
+        defocusU_batch, defocusV_batch, defocusAngle_batch, cs_batch = batch_params[5:]
+
+        # Batch CTFs
+        kv_batch = self.decoder.generator.kv
+        ctf = computeCTF(defocusU_batch, defocusV_batch, defocusAngle_batch, cs_batch, kv_batch,
+                         self.decoder.generator.sr, self.decoder.generator.pad_factor,
+                         [self.decoder.generator.xsize, int(0.5 * self.decoder.generator.xsize + 1)],
+                         batch_size_scope, self.decoder.generator.applyCTF)
+
+        return rot_batch, tilt_batch, psi_batch, shift_x_batch, shift_y_batch, ctf
+
+    def reconstruction_masks(self):
+        # Projection masks follow the poses of the current batch, so they are computed once per step and
+        # shared by both reconstruction losses
+        # Masks are not learned, so they are kept out of the backward pass
+        ft_mask_imgs = self.decoder.generator.fftResizeImage(tf.stop_gradient(self.decoder.generator.mask_imgs))
+        mask_imgs_ori = self.decoder.generator.ifftResizeImage(ft_mask_imgs, self.decoder.generator.xsize)
+        mask_imgs_ori = tf.cast(tf.not_equal(mask_imgs_ori, 0.0), mask_imgs_ori.dtype)
+
+        if self.train_size == self.decoder.generator.xsize:
+            return mask_imgs_ori, mask_imgs_ori
+
+        mask_imgs_scl = self.decoder.generator.ifftResizeImage(ft_mask_imgs, self.train_size)
+        mask_imgs_scl = tf.cast(tf.not_equal(mask_imgs_scl, 0.0), mask_imgs_scl.dtype)
+
+        return mask_imgs_ori, mask_imgs_scl
+
+    def reconstruction_losses(self, images, decoded_het_ctf):
+        # Reconstruction masks for projections (Decoder and train size)
+        mask_imgs_ori, mask_imgs_scl = self.reconstruction_masks()
+
+        # Reconstruction loss for original size images
+        ft_images = self.decoder.generator.fftResizeImage(tf.stop_gradient(images))
+        images_masked = mask_imgs_ori * self.decoder.generator.ifftResizeImage(ft_images, self.decoder.generator.xsize)
+        loss_het_ori = tf.cast(self.decoder.generator.cost_function(tf.cast(images_masked, self.precision_scaled),
+                                                                    tf.cast(decoded_het_ctf, self.precision_scaled)),
+                               self.precision)
+
+        # Both losses compare the same images when the train size matches the decoder size
+        if self.train_size == self.decoder.generator.xsize:
+            return loss_het_ori, loss_het_ori
+
+        # Reconstruction loss for downscaled images
+        images_masked = mask_imgs_scl * self.decoder.generator.ifftResizeImage(ft_images, self.train_size)
+        decoded_het_scl = self.decoder.generator.resizeImageFourier(decoded_het_ctf, self.train_size)
+        loss_het_scl = tf.cast(self.decoder.generator.cost_function(tf.cast(images_masked, self.precision_scaled),
+                                                                    tf.cast(decoded_het_scl, self.precision_scaled)),
+                               self.precision)
+
+        return loss_het_ori, loss_het_scl
+
+    def multires_loss(self, filt_images, filt_decoded):
+        # Resolution levels are moved to the leading axis so the cost of every level is evaluated at once
+        filt_images = tf.transpose(tf.cast(filt_images, self.precision_scaled), [3, 0, 1, 2])[..., None]
+        filt_decoded = tf.transpose(tf.cast(filt_decoded, self.precision_scaled), [3, 0, 1, 2])[..., None]
+        fn = lambda inp: self.decoder.generator.cost_function(inp[0], inp[1])
+        return tf.reduce_sum(tf.vectorized_map(fn, (filt_images, filt_decoded)), axis=0)
+
+    def compile(self, *args, **kwargs):
+        super(AutoEncoder, self).compile(*args, **kwargs)
+        if self.grad_accum_steps > 1:
+            self.build_grad_accum()
+
+    def build_grad_accum(self):
+        # Variables cannot be created inside the compiled train step, so the accumulators and the optimizer
+        # slots are created here. The accumulators are held in a plain namespace, which Keras does not track,
+        # so they are not part of the model weights
+        if not self.built:
+            raise ValueError("The model must be built before compiling it with grad_accum_steps > 1")
+        self.grad_accum = SimpleNamespace(
+            grads=[tf.Variable(tf.zeros_like(weight), trainable=False) for weight in self.trainable_weights],
+            step=tf.Variable(0, trainable=False, dtype=tf.int32))
+        self.optimizer.build(self.trainable_weights)
+
+    def accumulate_gradients(self, grads):
+        # Gradients are added over grad_accum_steps batches and applied as a single (averaged) optimizer update
+        for accum, grad in zip(self.grad_accum.grads, grads):
+            if grad is not None:
+                accum.assign_add(tf.cast(grad, accum.dtype))
+        self.grad_accum.step.assign_add(1)
+
+        def apply_accumulated():
+            accum_grads = [accum / float(self.grad_accum_steps) for accum in self.grad_accum.grads]
+            self.optimizer.apply_gradients(zip(accum_grads, self.trainable_weights))
+            for accum in self.grad_accum.grads:
+                accum.assign(tf.zeros_like(accum))
+            self.grad_accum.step.assign(0)
+            return tf.constant(True)
+
+        return tf.cond(tf.equal(self.grad_accum.step, self.grad_accum_steps), apply_accumulated,
+                       lambda: tf.constant(False))
+
     def train_step(self, data):
         inputs = data[0]
 
@@ -781,14 +999,15 @@ class AutoEncoder(Model):
         # Update batch_size (in case it is incomplete)
         batch_size_scope = tf.shape(images)[0]
 
-        # Precompute batch aligments
-        self.decoder.generator.rot_batch = tf.cast(tf.gather(self.decoder.generator.angle_rot, indexes, axis=0), self.precision)
-        self.decoder.generator.tilt_batch = tf.cast(tf.gather(self.decoder.generator.angle_tilt, indexes, axis=0), self.precision)
-        self.decoder.generator.psi_batch = tf.cast(tf.gather(self.decoder.generator.angle_psi, indexes, axis=0), self.precision)
-
-        # Precompute batch shifts
-        self.decoder.generator.shifts_batch = [tf.cast(tf.gather(self.decoder.generator.shift_x, indexes, axis=0), self.precision),
-                                               tf.cast(tf.gather(self.decoder.generator.shift_y, indexes, axis=0), self.precision)]
+        # Precompute batch aligments, shifts and CTFs
+        rot_batch, tilt_batch, psi_batch, shift_x_batch, shift_y_batch, ctf = self.prepare_batch(indexes,
+                                                                                                 batch_size_scope)
+        self.decoder.generator.rot_batch = tf.cast(rot_batch, self.precision)
+        self.decoder.generator.tilt_batch = tf.cast(tilt_batch, self.precision)
+        self.decoder.generator.psi_batch = tf.cast(psi_batch, self.precision)
+        self.decoder.generator.shifts_batch = [tf.cast(shift_x_batch, self.precision),
+                                               tf.cast(shift_y_batch, self.precision)]
+        self.decoder.generator.ctf = ctf
 
         # Random permutations of angles and shifts
         euler_batch = tf.stack([self.decoder.generator.rot_batch,
@@ -798,18 +1017,6 @@ class AutoEncoder(Model):
         euler_batch_perm = tf.random.shuffle(euler_batch)
         shifts_batch_perm = tf.random.shuffle(shifts_batch)
 
-        # Precompute batch CTFs
-        defocusU_batch = tf.gather(self.decoder.generator.defocusU, indexes, axis=0)
-        defocusV_batch = tf.gather(self.decoder.generator.defocusV, indexes, axis=0)
-        defocusAngle_batch = tf.gather(self.decoder.generator.defocusAngle, indexes, axis=0)
-        cs_batch = tf.gather(self.decoder.generator.cs, indexes, axis=0)
-        kv_batch = self.decoder.generator.kv
-        ctf = computeCTF(defocusU_batch, defocusV_batch, defocusAngle_batch, cs_batch, kv_batch,
-                         self.decoder.generator.sr, self.decoder.generator.pad_factor,
-                         [self.decoder.generator.xsize, int(0.5 * self.decoder.generator.xsize + 1)],
-                         batch_size_scope, self.decoder.generator.applyCTF)
-        self.decoder.generator.ctf = ctf
-
         # Random permutations of CTF
         ctf_perm = tf.random.shuffle(ctf)
 
@@ -819,16 +1026,19 @@ class AutoEncoder(Model):
             if self.mode == "spa":
                 inputs = images
             elif self.mode == "tomo":
-                inputs[0] = images
+                inputs = (images,) + tuple(inputs[1:])
 
         with tf.GradientTape() as tape:
             # Forward pass (first encoder and decoder)
             l_rows, l_shifts, l_het, l_het_label = self.encoder_exp(inputs)
             het, rows, shifts = self.latent(l_het), self.rows(l_rows), self.shifts(l_shifts)
+            if not self.refPose:
+                # Pose deltas are dropped when the pose is not refined (no need to scale them by refPose)
+                rows, shifts = tf.zeros_like(rows), tf.zeros_like(shifts)
 
             if self.mode == "spa":
                 decoded_het, decoded_het_ctf, delta_het = self.decoder(
-                    [self.refPose * rows, self.refPose * shifts, het])
+                    [rows, shifts, het])
 
                 if self.disantangle_pose:
                     # Forward pass (second encoder - no permutation)
@@ -851,13 +1061,13 @@ class AutoEncoder(Model):
                     self.decoder.generator.tilt_batch = euler_batch_perm[..., 1]
                     self.decoder.generator.psi_batch = euler_batch_perm[..., 2]
                     self.decoder.generator.shifts_batch = [shifts_batch_perm[..., 0], shifts_batch_perm[..., 1]]
-                    decoded_het, _, _ = self.decoder([self.refPose * rows, self.refPose * shifts, het])
+                    decoded_het, _, _ = self.decoder([rows, shifts, het])
                     _, _, l_het_clean_perm, _ = self.encoder_clean(decoded_het)
                     het_clean_perm = self.latent(l_het_clean_perm)
 
             elif self.mode == "tomo":
                 het_label = self.latent(l_het_label)
-                decoded_het, decoded_het_ctf, delta_het = self.decoder([self.refPose * rows, self.refPose * shifts, het_label])
+                decoded_het, decoded_het_ctf, delta_het = self.decoder([rows, shifts, het_label])
 
             # delta_het = self.decoder.decode_het(het)
 
@@ -871,14 +1081,15 @@ class AutoEncoder(Model):
                 updates = delta_het
 
             # L1 penalization delta_het
-            delta_het = tf.tile(self.decoder.generator.values[None, :], [batch_size_scope, 1]) + updates
-            l1_loss_het = tf.cast(self.l1_lambda * tf.reduce_mean(tf.abs(tf.cast(delta_het, self.precision_scaled))), self.precision)
+            delta_het = self.values_bcast + updates
+            delta_het_scaled = tf.cast(delta_het, self.precision_scaled)
+            l1_loss_het = tf.cast(self.l1_lambda * tf.reduce_mean(tf.abs(delta_het_scaled)), self.precision)
 
             # Volume range loss
             if self.decoder.generator.null_ref or not self.isFocused:
                 hist_loss = 0.0
             else:
-                orig_values = tf.tile(self.decoder.generator.values_no_masked[None, :], [batch_size_scope, 1])
+                orig_values = self.decoder.generator.values_no_masked[None, :]
                 values_in_het = tf.cast(tf.gather(delta_het, self.decoder.generator.values_in_mask, axis=1), self.precision_scaled)
                 values_in_mask = tf.cast(tf.gather(orig_values, self.decoder.generator.values_in_mask, axis=1), self.precision_scaled)
                 # val_range = [tf.reduce_min(values_in_mask), tf.reduce_max(values_in_mask)]
@@ -898,9 +1109,9 @@ class AutoEncoder(Model):
             d_mse_loss *= self.mse_lambda
 
             # Negative loss
-            mask = tf.less(delta_het, 0.0)
-            delta_neg = tf.boolean_mask(delta_het, mask)
-            delta_neg = tf.reduce_mean(tf.abs(tf.cast(delta_neg, self.precision_scaled)))
+            delta_neg = tf.nn.relu(-delta_het_scaled)
+            num_neg = tf.reduce_sum(tf.cast(tf.less(delta_het, 0.0), self.precision_scaled))
+            delta_neg = tf.reduce_sum(delta_neg) / tf.maximum(num_neg, 1.0)
             neg_loss_het = tf.cast(self.l1_lambda * delta_neg, self.precision)
 
             # # Positive loss
@@ -910,35 +1121,14 @@ class AutoEncoder(Model):
             # delta_pos = tf.reduce_mean(tf.abs(delta_pos))
             # pos_loss_het = self.l1_lambda * delta_pos / delta_pos_size
 
-            # Reconstruction mask for projections (Decoder size)
-            mask_imgs = self.decoder.generator.resizeImageFourier(self.decoder.generator.mask_imgs,
-                                                                  self.decoder.generator.xsize)
-            mask_imgs = tf.abs(mask_imgs)
-            mask_imgs = tf.math.divide_no_nan(mask_imgs, mask_imgs)
-
-            # Reconstruction loss for original size images
-            images_masked = mask_imgs * self.decoder.generator.resizeImageFourier(images, self.decoder.generator.xsize)
-            loss_het_ori = tf.cast(self.decoder.generator.cost_function(tf.cast(images_masked, self.precision_scaled),
-                                                                        tf.cast(decoded_het_ctf, self.precision_scaled)), self.precision)
-
-            # Reconstruction mask for projections (Train size)
-            mask_imgs = self.decoder.generator.resizeImageFourier(self.decoder.generator.mask_imgs, self.train_size)
-            mask_imgs = tf.abs(mask_imgs)
-            mask_imgs = tf.math.divide_no_nan(mask_imgs, mask_imgs)
-
-            # Reconstruction loss for downscaled images
-            images_masked = mask_imgs * self.decoder.generator.resizeImageFourier(images, self.train_size)
-            decoded_het_scl = self.decoder.generator.resizeImageFourier(decoded_het_ctf, self.train_size)
-            loss_het_scl = tf.cast(self.decoder.generator.cost_function(tf.cast(images_masked, self.precision_scaled),
-                                                                        tf.cast(decoded_het_scl, self.precision_scaled)), self.precision)
+            # Reconstruction losses for original size and downscaled images
+            loss_het_ori, loss_het_scl = self.reconstruction_losses(images, decoded_het_ctf)
 
             # MR loss
             if self.filters is not None:
                 filt_images = apply_blur_filters_to_batch(images, self.filters)
                 filt_decoded = apply_blur_filters_to_batch(decoded_het_ctf, self.filters)
-                for idx in range(self.multires_levels):
-                    loss_het_ori += tf.cast(self.decoder.generator.cost_function(tf.cast(filt_images, self.precision_scaled)[..., idx][..., None],
-                                                                                 tf.cast(filt_decoded, self.precision_scaled)[..., idx][..., None]), self.precision)
+                loss_het_ori += tf.cast(self.multires_loss(filt_images, filt_decoded), self.precision)
                 loss_het_ori = tf.cast(tf.cast(loss_het_ori, self.precision_scaled) / (float(self.multires_levels) + 1), self.precision)
 
             # Loss disantagled (pose)
@@ -975,7 +1165,10 @@ class AutoEncoder(Model):
         # gradients = self.optimizer.get_unscaled_gradients(scaled_gradients)
         # self.optimizer.apply_gradients(zip(gradients, self.trainable_variables))
         grads = tape.gradient(total_loss, self.trainable_weights)
-        self.optimizer.apply_gradients(zip(grads, self.trainable_weights))
+        if self.grad_accum_steps > 1:
+            self.accumulate_gradients(grads)
+        else:
+            self.optimizer.apply_gradients(zip(grads, self.trainable_weights))
 
         self.total_loss_tracker.update_state(total_loss)
         self.loss_het_tracker.update_state(rec_loss)
@@ -1006,18 +1199,15 @@ class AutoEncoder(Model):
         # Update batch_size (in case it is incomplete)
         batch_size_scope = tf.shape(images)[0]
 
-        # Precompute batch aligments
-        self.decoder.generator.rot_batch = tf.cast(tf.gather(self.decoder.generator.angle_rot, indexes, axis=0),
-                                                   self.precision)
-        self.decoder.generator.tilt_batch = tf.cast(tf.gather(self.decoder.generator.angle_tilt, indexes, axis=0),
-                                                    self.precision)
-        self.decoder.generator.psi_batch = tf.cast(tf.gather(self.decoder.generator.angle_psi, indexes, axis=0),
-                                                   self.precision)
-
-        # Precompute batch shifts
-        self.decoder.generator.shifts_batch = [
-            tf.cast(tf.gather(self.decoder.generator.shift_x, indexes, axis=0), self.precision),
-            tf.cast(tf.gather(self.decoder.generator.shift_y, indexes, axis=0), self.precision)]
+        # Precompute batch aligments, shifts and CTFs
+        rot_batch, tilt_batch, psi_batch, shift_x_batch, shift_y_batch, ctf = self.prepare_batch(indexes,
+                                                                                                 batch_size_scope)
+        self.decoder.generator.rot_batch = tf.cast(rot_batch, self.precision)
+        self.decoder.generator.tilt_batch = tf.cast(tilt_batch, self.precision)
+        self.decoder.generator.psi_batch = tf.cast(psi_batch, self.precision)
+        self.decoder.generator.shifts_batch = [tf.cast(shift_x_batch, self.precision),
+                                               tf.cast(shift_y_batch, self.precision)]
+        self.decoder.generator.ctf = ctf
 
         # Random permutations of angles and shifts
         euler_batch = tf.stack([self.decoder.generator.rot_batch,
@@ -1027,18 +1217,6 @@ class AutoEncoder(Model):
         euler_batch_perm = tf.random.shuffle(euler_batch)
         shifts_batch_perm = tf.random.shuffle(shifts_batch)
 
-        # Precompute batch CTFs
-        defocusU_batch = tf.gather(self.decoder.generator.defocusU, indexes, axis=0)
-        defocusV_batch = tf.gather(self.decoder.generator.defocusV, indexes, axis=0)
-        defocusAngle_batch = tf.gather(self.decoder.generator.defocusAngle, indexes, axis=0)
-        cs_batch = tf.gather(self.decoder.generator.cs, indexes, axis=0)
-        kv_batch = self.decoder.generator.kv
-        ctf = computeCTF(defocusU_batch, defocusV_batch, defocusAngle_batch, cs_batch, kv_batch,
-                         self.decoder.generator.sr, self.decoder.generator.pad_factor,
-                         [self.decoder.generator.xsize, int(0.5 * self.decoder.generator.xsize + 1)],
-                         batch_size_scope, self.decoder.generator.applyCTF)
-        self.decoder.generator.ctf = ctf
-
         # Random permutations of CTF
         ctf_perm = tf.random.shuffle(ctf)
 
@@ -1048,15 +1226,18 @@ class AutoEncoder(Model):
             if self.mode == "spa":
                 inputs = images
             elif self.mode == "tomo":
-                inputs[0] = images
+                inputs = (images,) + tuple(inputs[1:])
 
             # Forward pass (first encoder and decoder)
         l_rows, l_shifts, l_het, l_het_label = self.encoder_exp(inputs)
         het, rows, shifts = self.latent(l_het), self.rows(l_rows), self.shifts(l_shifts)
+        if not self.refPose:
+            # Pose deltas are dropped when the pose is not refined (no need to scale them by refPose)
+            rows, shifts = tf.zeros_like(rows), tf.zeros_like(shifts)
 
         if self.mode == "spa":
             decoded_het, decoded_het_ctf, delta_het = self.decoder(
-                [self.refPose * rows, self.refPose * shifts, het])
+                [rows, shifts, het])
 
             if self.disantangle_pose:
                 # Forward pass (second encoder - no permutation)
@@ -1079,14 +1260,14 @@ class AutoEncoder(Model):
                 self.decoder.generator.tilt_batch = euler_batch_perm[..., 1]
                 self.decoder.generator.psi_batch = euler_batch_perm[..., 2]
                 self.decoder.generator.shifts_batch = [shifts_batch_perm[..., 0], shifts_batch_perm[..., 1]]
-                decoded_het, _, _ = self.decoder([self.refPose * rows, self.refPose * shifts, het])
+                decoded_het, _, _ = self.decoder([rows, shifts, het])
                 _, _, l_het_clean_perm, _ = self.encoder_clean(decoded_het)
                 het_clean_perm = self.latent(l_het_clean_perm)
 
         elif self.mode == "tomo":
             het_label = self.latent(l_het_label)
             decoded_het, decoded_het_ctf, delta_het = self.decoder(
-                [self.refPose * rows, self.refPose * shifts, het_label])
+                [rows, shifts, het_label])
 
         # delta_het = self.decoder.decode_het(het)
 
@@ -1100,15 +1281,15 @@ class AutoEncoder(Model):
             updates = delta_het
 
         # L1 penalization delta_het
-        delta_het = tf.tile(self.decoder.generator.values[None, :], [batch_size_scope, 1]) + updates
-        l1_loss_het = tf.cast(self.l1_lambda * tf.reduce_mean(tf.abs(tf.cast(delta_het, self.precision_scaled))),
-                              self.precision)
+        delta_het = self.values_bcast + updates
+        delta_het_scaled = tf.cast(delta_het, self.precision_scaled)
+        l1_loss_het = tf.cast(self.l1_lambda * tf.reduce_mean(tf.abs(delta_het_scaled)), self.precision)
 
         # Volume range loss
         if self.decoder.generator.null_ref or not self.isFocused:
             hist_loss = 0.0
         else:
-            orig_values = tf.tile(self.decoder.generator.values_no_masked[None, :], [batch_size_scope, 1])
+            orig_values = self.decoder.generator.values_no_masked[None, :]
             values_in_het = tf.cast(tf.gather(delta_het, self.decoder.generator.values_in_mask, axis=1), self.precision_scaled)
             values_in_mask = tf.cast(tf.gather(orig_values, self.decoder.generator.values_in_mask, axis=1),
                                      self.precision_scaled)
@@ -1132,9 +1313,9 @@ class AutoEncoder(Model):
         d_mse_loss *= self.mse_lambda
 
         # Negative loss
-        mask = tf.less(delta_het, 0.0)
-        delta_neg = tf.boolean_mask(delta_het, mask)
-        delta_neg = tf.reduce_mean(tf.abs(tf.cast(delta_neg, self.precision_scaled)))
+        delta_neg = tf.nn.relu(-delta_het_scaled)
+        num_neg = tf.reduce_sum(tf.cast(tf.less(delta_het, 0.0), self.precision_scaled))
+        delta_neg = tf.reduce_sum(delta_neg) / tf.maximum(num_neg, 1.0)
         neg_loss_het = tf.cast(self.l1_lambda * delta_neg, self.precision)
 
         # # Positive loss
@@ -1144,39 +1325,14 @@ class AutoEncoder(Model):
         # delta_pos = tf.reduce_mean(tf.abs(delta_pos))
         # pos_loss_het = self.l1_lambda * delta_pos / delta_pos_size
 
-        # Reconstruction mask for projections (Decoder size)
-        mask_imgs = self.decoder.generator.resizeImageFourier(self.decoder.generator.mask_imgs,
-                                                              self.decoder.generator.xsize)
-        mask_imgs = tf.abs(mask_imgs)
-        mask_imgs = tf.math.divide_no_nan(mask_imgs, mask_imgs)
-
-        # Reconstruction loss for original size images
-        images_masked = mask_imgs * self.decoder.generator.resizeImageFourier(images, self.decoder.generator.xsize)
-        loss_het_ori = tf.cast(self.decoder.generator.cost_function(tf.cast(images_masked, self.precision_scaled),
-                                                                    tf.cast(decoded_het_ctf, self.precision_scaled)),
-                               self.precision)
-
-        # Reconstruction mask for projections (Train size)
-        mask_imgs = self.decoder.generator.resizeImageFourier(self.decoder.generator.mask_imgs, self.train_size)
-        mask_imgs = tf.abs(mask_imgs)
-        mask_imgs = tf.math.divide_no_nan(mask_imgs, mask_imgs)
-
-        # Reconstruction loss for downscaled images
-        images_masked = mask_imgs * self.decoder.generator.resizeImageFourier(images, self.train_size)
-        decoded_het_scl = self.decoder.generator.resizeImageFourier(decoded_het_ctf, self.train_size)
-        loss_het_scl = tf.cast(self.decoder.generator.cost_function(tf.cast(images_masked, self.precision_scaled),
-                                                                    tf.cast(decoded_het_scl, self.precision_scaled)),
-                               self.precision)
+        # Reconstruction losses for original size and downscaled images
+        loss_het_ori, loss_het_scl = self.reconstruction_losses(images, decoded_het_ctf)
 
         # MR loss
         if self.filters is not None:
             filt_images = apply_blur_filters_to_batch(images, self.filters)
             filt_decoded = apply_blur_filters_to_batch(decoded_het_ctf, self.filters)
-            for idx in range(self.multires_levels):
-                loss_het_ori += tf.cast(
-                    self.decoder.generator.cost_function(tf.cast(filt_images, self.precision_scaled)[..., idx][..., None],
-                                                         tf.cast(filt_decoded, self.precision_scaled)[..., idx][..., None]),
-                    self.precision)
+            loss_het_ori += tf.cast(self.multires_loss(filt_images, filt_decoded), self.precision)
             loss_het_ori = tf.cast(tf.cast(loss_het_ori, self.precision_scaled) / (float(self.multires_levels) + 1),
                                    self.precision)
 
@@ -1224,10 +1380,11 @@ class AutoEncoder(Model):
         }
 
     def eval_encoder(self, x):
-        # Precompute batch aligments
-        self.decoder.generator.rot_batch = x[1]
-        self.decoder.generator.tilt_batch = x[1]
-        self.decoder.generator.psi_batch = x[1]
+        # Precompute batch aligments (x[1] holds the rot, tilt and psi angles with shape (B, 3))
+        rot_batch, tilt_batch, psi_batch = tf.unstack(x[1], 3, axis=-1)
+        self.decoder.generator.rot_batch = rot_batch
+        self.decoder.generator.tilt_batch = tilt_batch
+        self.decoder.generator.psi_batch = psi_batch
 
         # Precompute batch shifts
         self.decoder.generator.shifts_batch = [x[2][:, 0], x[2][:, 1]]
@@ -1239,14 +1396,18 @@ class AutoEncoder(Model):
         if self.CTF == "wiener":
             x[0] = self.decoder.generator.wiener2DFilter(x[0])
 
-        l_rot, l_shifts, l_het = self.encoder_exp(x[0])
-        het, rot, shifts = self.latent(l_het), self.rows(l_rot), self.shifts(l_shifts)
+        # Single device to host copy for all the encoder outputs
+        encoded = self.encode_inference(tf.cast(x[0], tf.float32)).numpy()
+        rot, shifts, het = np.split(encoded, [3, 5], axis=1)
 
-        return self.refPose * rot.numpy(), self.refPose * shifts.numpy(), het.numpy()
+        return self.refPose * rot, self.refPose * shifts, het
 
-    def eval_volume_het(self, x_het, allCoords=False, filter=True, only_pos=False, add_to_original=False):
-        batch_size = x_het.shape[0]
+    def encode(self, images):
+        l_rot, l_shifts, l_het, _ = self.encoder_exp(images)
+        het, rot, shifts = self.latent(l_het), self.rows(l_rot), self.shifts(l_shifts)
+        return tf.concat([tf.cast(rot, tf.float32), tf.cast(shifts, tf.float32), tf.cast(het, tf.float32)], axis=1)
 
+    def eval_volume_het(self, x_het, allCoords=False, filter=True, only_pos=False, add_to_original=False):
         if allCoords and self.decoder.generator.step > 1:
             new_coords, prev_coords = self.decoder.generator.getAllCoordsMask(), \
                 self.decoder.generator.coords
@@ -1257,17 +1418,20 @@ class AutoEncoder(Model):
         volume_path = Path(self.decoder.generator.filename.parent, 'volume.mrc')
         if add_to_original and volume_path.exists():
             original_volume = ImageHandler(str(volume_path)).getData()
-            original_volume = np.tile(original_volume[None, ...], (x_het.shape[0], 1, 1, 1))
+            original_volume = np.broadcast_to(original_volume[None, ...],
+                                              (x_het.shape[0],) + original_volume.shape)
         else:
             original_volume = None
 
-        # Volume
-        volume = np.zeros((batch_size, self.decoder.generator.xsize,
-                           self.decoder.generator.xsize,
-                           self.decoder.generator.xsize), dtype=np.float32)
+        # Volume (accumulated in place on the first decoded batch, no extra buffer is needed)
+        volume = None
         for coords in new_coords:
             self.decoder.generator.coords = coords
-            volume += self.decoder.eval_volume_het(x_het, filter=filter, only_pos=only_pos)
+            decoded = self.decoder.eval_volume_het(x_het, filter=filter, only_pos=only_pos)
+            if volume is None:
+                volume = decoded
+            else:
+                volume += decoded
 
         # if original_volume is not None:
         #     original_norm = match_histograms(original_volume, volume)
@@ -1279,6 +1443,12 @@ class AutoEncoder(Model):
 
         return volume
 
+    def iter_volumes_het(self, x_het, batch_size=4, **kwargs):
+        # Decode the volumes in small batches and yield them one by one (only a batch is kept in memory)
+        for idx in range(0, x_het.shape[0], batch_size):
+            for volume in self.eval_volume_het(x_het[idx:idx + batch_size], **kwargs):
+                yield volume
+
     def predict(self, data, predict_mode="het", applyCTF=False):
         self.predict_mode, self.applyCTF = predict_mode, applyCTF
         self.predict_function = None
@@ -1301,25 +1471,13 @@ class AutoEncoder(Model):
         # Update batch_size (in case it is incomplete)
         batch_size_scope = tf.shape(images)[0]
 
-        # Precompute batch aligments
-        self.decoder.generator.rot_batch = tf.gather(self.decoder.generator.angle_rot, indexes, axis=0)
-        self.decoder.generator.tilt_batch = tf.gather(self.decoder.generator.angle_tilt, indexes, axis=0)
-        self.decoder.generator.psi_batch = tf.gather(self.decoder.generator.angle_psi, indexes, axis=0)
-
-        # Precompute batch shifts
-        self.decoder.generator.shifts_batch = [tf.gather(self.decoder.generator.shift_x, indexes, axis=0),
-                                               tf.gather(self.decoder.generator.shift_y, indexes, axis=0)]
-
-        # Precompute batch CTFs
-        defocusU_batch = tf.gather(self.decoder.generator.defocusU, indexes, axis=0)
-        defocusV_batch = tf.gather(self.decoder.generator.defocusV, indexes, axis=0)
-        defocusAngle_batch = tf.gather(self.decoder.generator.defocusAngle, indexes, axis=0)
-        cs_batch = tf.gather(self.decoder.generator.cs, indexes, axis=0)
-        kv_batch = self.decoder.generator.kv
-        ctf = computeCTF(defocusU_batch, defocusV_batch, defocusAngle_batch, cs_batch, kv_batch,
-                         self.decoder.generator.sr, self.decoder.generator.pad_factor,
-                         [self.decoder.generator.xsize, int(0.5 * self.decoder.generator.xsize + 1)],
-                         batch_size_scope, self.decoder.generator.applyCTF)
+        # Precompute batch aligments, shifts and CTFs
+        rot_batch, tilt_batch, psi_batch, shift_x_batch, shift_y_batch, ctf = self.prepare_batch(indexes,
+                                                                                                 batch_size_scope)
+        self.decoder.generator.rot_batch = rot_batch
+        self.decoder.generator.tilt_batch = tilt_batch
+        self.decoder.generator.psi_batch = psi_batch
+        self.decoder.generator.shifts_batch = [shift_x_batch, shift_y_batch]
         self.decoder.generator.ctf = ctf
 
         # Wiener filter
@@ -1328,7 +1486,7 @@ class AutoEncoder(Model):
             if self.mode == "spa":
                 inputs = images
             elif self.mode == "tomo":
-                inputs[0] = images
+                inputs = (images,) + tuple(inputs[1:])
 
         # Predict images with CTF applied?
         if self.applyCTF == 1:
@@ -1345,8 +1503,12 @@ class AutoEncoder(Model):
                 het, het_l, rot, shifts = self.latent(l_het), self.latent(l_l_het), self.rows(l_rot), self.shifts(l_shifts)
                 return rot, shifts, het, het_l
         elif "particles" in self.predict_mode:
-            l_rot, l_shifts, l_het, _ = self.encoder_exp(inputs)
-            het, rot, shifts = self.latent(l_het), self.rows(l_rot), self.shifts(l_shifts)
+            if len(data) > 2:
+                # Poses and latent codes already predicted for this batch (no need to encode it again)
+                rot, shifts, het = data[2]
+            else:
+                l_rot, l_shifts, l_het, _ = self.encoder_exp(inputs)
+                het, rot, shifts = self.latent(l_het), self.rows(l_rot), self.shifts(l_shifts)
             if "ctf" in self.predict_mode:
                 return self.decoder([rot, shifts, het])[1]
             else:
@@ -26,22 +26,21 @@
 
 
 import tensorflow as tf
-import tensorflow_addons as tfa
 from keras.initializers import RandomUniform, RandomNormal, Zeros, Constant, Orthogonal
 from tensorflow.keras import layers, Input, Model
 
+import h5py
 import numpy as np
-from scipy.ndimage import gaussian_filter
 import scipy.stats as st
 
 from tensorflow_toolkit.utils import computeCTF, gramSchmidt, euler_matrix_batch, full_fft_pad, full_ifft_pad, \
-    quaternion_to_rotation_matrix
+    quaternion_to_rotation_matrix, read_h5_weights
 from tensorflow_toolkit.layers.siren import Sine, SIRENFirstLayerInitializer, SIRENInitializer
 
 
 def resizeImageFourier(images, out_size, pad_factor=1):
-    # Sizes
-    xsize = tf.shape(images)[1]
+    # Sizes (static when known so the normalization is folded at trace time)
+    xsize = images.shape[1] if images.shape[1] is not None else tf.shape(images)[1]
     pad_size = pad_factor * xsize
     pad_out_size = pad_factor * out_size
 
@@ -49,7 +48,10 @@ def resizeImageFourier(images, out_size, pad_factor=1):
     ft_images = full_fft_pad(images, pad_size, pad_size)
 
     # Normalization constant
-    norm = tf.cast(pad_out_size, dtype=tf.float32) / tf.cast(pad_size, dtype=tf.float32)
+    if isinstance(pad_size, int):
+        norm = float(pad_out_size) / float(pad_size)
+    else:
+        norm = tf.cast(pad_out_size, dtype=tf.float32) / tf.cast(pad_size, dtype=tf.float32)
 
     # Resizing
     ft_images = tf.image.resize_with_crop_or_pad(ft_images[..., None], pad_out_size, pad_out_size)[..., 0]
@@ -61,28 +63,29 @@ def resizeImageFourier(images, out_size, pad_factor=1):
     return images
 
 
-def gaussian_kernel(size: int, std: float):
+def gaussian_kernel(size: int, std):
     """
-    Creates a 2D Gaussian kernel with specified size and standard deviation.
+    Creates 1D Gaussian kernels with specified size and standard deviation(s). The outer product
+    of a kernel with itself gives the (separable) 2D Gaussian kernel.
 
     Args:
-    - size: The size of the kernel (will be square).
-    - std: The standard deviation of the Gaussian.
+    - size: The size of the kernel.
+    - std: The standard deviation of the Gaussian (or an array of standard deviations).
 
     Returns:
-    - A 2D numpy array representing the Gaussian kernel.
+    - A numpy array representing the Gaussian kernel(s), with shape (..., size - 1).
     """
+    std = np.asarray(std, dtype=float)[..., None]
     interval = (2 * std + 1.) / size
-    x = np.linspace(-std - interval / 2., std + interval / 2., size)
-    kern1d = np.diff(st.norm.cdf(x))
-    kernel_raw = np.sqrt(np.outer(kern1d, kern1d))
-    kernel = kernel_raw / kernel_raw.sum()
+    x = -std - interval / 2. + np.linspace(0., 1., size) * (2. * std + interval)
+    kern1d = np.sqrt(np.diff(st.norm.cdf(x), axis=-1))
+    kernel = kern1d / kern1d.sum(axis=-1, keepdims=True)
     return kernel
 
 
 def create_blur_filters(num_filters, max_std, filter_size):
     """
-    Create a set of Gaussian blur filters with varying standard deviations.
+    Create a set of separable Gaussian blur filters with varying standard deviations.
 
     Args:
     - num_filters: The number of blur filters to create.
@@ -90,17 +93,16 @@ def create_blur_filters(num_filters, max_std, filter_size):
     - filter_size: The size of each filter.
 
     Returns:
-    - A tensor containing the filters.
+    - A tuple with the vertical (filter_size, 1, 1, N) and horizontal (1, filter_size, N, 1)
+      filter tensors.
     """
+    # All the kernels are computed at once (filter_size, N)
     std_intervals = np.linspace(0.1, max_std, num_filters)
-    filters = []
-    for std in std_intervals:
-        kernel = gaussian_kernel(filter_size, std)
-        kernel = np.expand_dims(kernel, axis=-1)
-        filters.append(kernel)
+    filters = gaussian_kernel(filter_size, std_intervals).T
 
-    filters = np.stack(filters, axis=-1)
-    return tf.constant(filters, dtype=tf.float32)
+    filters_h = tf.constant(filters[:, None, None, :], dtype=tf.float32)
+    filters_w = tf.constant(filters[None, :, :, None], dtype=tf.float32)
+    return filters_h, filters_w
 
 
 def apply_blur_filters_to_batch(images, filters):
@@ -109,125 +111,293 @@ def apply_blur_filters_to_batch(images, filters):
 
     Args:
     - images: Batch of images with shape (B, W, H, 1).
-    - filters: Filters to apply, with shape (filter_size, filter_size, 1, N).
+    - filters: Separable filters to apply, as returned by create_blur_filters.
 
     Returns:
     - Batch of blurred images with shape (B, W, H, N).
     """
-    # Apply the filters
-    blurred_images = tf.nn.depthwise_conv2d(images, filters, strides=[1, 1, 1, 1], padding='SAME')
+    # Apply the filters (one pass per axis)
+    filters_h, filters_w = tf.cast(filters[0], images.dtype), tf.cast(filters[1], images.dtype)
+    blurred_images = tf.nn.depthwise_conv2d(images, filters_h, strides=[1, 1, 1, 1], padding='SAME')
+    blurred_images = tf.nn.depthwise_conv2d(blurred_images, filters_w, strides=[1, 1, 1, 1], padding='SAME')
     return blurred_images
 
 
-def total_variation_loss(volume, diff1, diff2, diff3):
+def gaussian_filter_kernels(filter_size, sigma):
     """
-    Computes the Total Variation Loss.
-    Encourages spatial smoothness in the image output.
+    Create the separable kernels of a Gaussian filter (same kernel as tfa.image.gaussian_filter2d).
 
-    Parameters:
-    volume (Tensor): The image tensor of shape (batch_size, depth, height, width)
-    diff1 (Tensor): Voxel value differences of shape (batch_size, depth - 1, height, width)
-    diff2 (Tensor): Voxel value differences of shape (batch_size, depth, height - 1, width)
-    diff3 (Tensor): Voxel value differences of shape (batch_size, depth, height, width - 1)
+    Args:
+    - filter_size: The size of the filter.
+    - sigma: The standard deviation of the Gaussian.
 
     Returns:
-    Tensor: The total variation loss.
+    - A tuple with the vertical (filter_size, 1, 1, 1) and horizontal (1, filter_size, 1, 1)
+      kernel tensors.
     """
+    x = np.arange(filter_size) - (filter_size - 1) / 2.
+    kernel = np.exp(-x ** 2. / (2. * sigma ** 2.))
+    kernel = kernel / kernel.sum()
+    kernel_h = tf.constant(kernel[:, None, None, None], dtype=tf.float32)
+    kernel_w = tf.constant(kernel[None, :, None, None], dtype=tf.float32)
+    return kernel_h, kernel_w
 
-    # Sum for both directions.
-    sum_axis = [1, 2, 3]
-    loss = tf.reduce_sum(tf.abs(diff1), axis=sum_axis) + \
-           tf.reduce_sum(tf.abs(diff2), axis=sum_axis) + \
-           tf.reduce_sum(tf.abs(diff3), axis=sum_axis)
 
-    # Normalize by the volume size
-    num_pixels = tf.cast(tf.reduce_prod(volume.shape[1:]), tf.float32)
-    loss /= num_pixels
+def separable_gaussian_filter(images, kernels):
+    """
+    Gaussian filtering of a batch of images with separable kernels and reflect padding.
 
-    return loss
+    Args:
+    - images: Batch of images with shape (B, W, H, 1).
+    - kernels: Separable kernels, as returned by gaussian_filter_kernels.
+
+    Returns:
+    - Batch of filtered images with shape (B, W, H, 1).
+    """
+    kernel_h, kernel_w = kernels
+    pad_h, pad_w = kernel_h.shape[0] - 1, kernel_w.shape[1] - 1
+    images = tf.pad(images, [[0, 0], [pad_h // 2, pad_h - pad_h // 2], [pad_w // 2, pad_w - pad_w // 2], [0, 0]],
+                    mode="REFLECT")
+    images = tf.nn.depthwise_conv2d(images, kernel_h, strides=[1, 1, 1, 1], padding='VALID')
+    images = tf.nn.depthwise_conv2d(images, kernel_w, strides=[1, 1, 1, 1], padding='VALID')
+    return images
+
+
+def gaussian_filter_transfer(filter_size, sigma, pad_size):
+    """
+    Fourier transfer function of the Gaussian filter built by gaussian_filter_kernels, laid out as the
+    shifted half spectrum returned by fft_pad (so it can be multiplied with the CTF).
+
+    Args:
+    - filter_size: The size of the filter.
+    - sigma: The standard deviation of the Gaussian.
+    - pad_size: Size of the padded images in Fourier space.
+
+    Returns:
+    - Transfer function tensor with shape (pad_size, pad_size // 2 + 1).
+    """
+    x = np.arange(filter_size) - (filter_size - 1) / 2.
+    kernel = np.exp(-x ** 2. / (2. * sigma ** 2.))
+    kernel = kernel / kernel.sum()
+
+    # Zero phase response of the (symmetric) kernel along each axis
+    transfer = lambda freqs: np.sum(kernel[None, :] * np.cos(2. * np.pi * freqs[:, None] * x[None, :]), axis=1)
+    transfer_2d = transfer(np.fft.fftfreq(pad_size))[:, None] * transfer(np.fft.rfftfreq(pad_size))[None, :]
+    return tf.constant(np.fft.fftshift(transfer_2d), dtype=tf.float32)
+
+
+def separable_gaussian_filter_3d(volumes, kernel):
+    """
+    Gaussian filtering of a batch of volumes with a separable kernel and symmetric padding (same as
+    scipy.ndimage.gaussian_filter with mode="reflect").
+
+    Args:
+    - volumes: Batch of volumes with shape (B, D, H, W, 1).
+    - kernel: 1D Gaussian kernel with an odd number of taps.
+
+    Returns:
+    - Batch of filtered volumes with shape (B, D, H, W, 1).
+    """
+    kernel = tf.reshape(kernel, [-1])
+    pad = (kernel.shape[0] - 1) // 2
+    volumes = tf.pad(volumes, [[0, 0], [pad, pad], [pad, pad], [pad, pad], [0, 0]], mode="SYMMETRIC")
+    for shape in ([-1, 1, 1, 1, 1], [1, -1, 1, 1, 1], [1, 1, -1, 1, 1]):
+        volumes = tf.nn.conv3d(volumes, tf.reshape(kernel, shape), strides=[1, 1, 1, 1, 1], padding='VALID')
+    return volumes
 
 
-def mse_smoothness_loss(volume, diff1, diff2, diff3):
+def smoothness_neighbours(xsize, indices):
     """
-    Computes an MSE-based smoothness loss.
-    This loss penalizes large intensity differences between adjacent pixels.
+    Precomputes the neighbour lookup tables needed to evaluate the smoothness losses of a volume
+    directly on its (indices, values) representation.
 
     Parameters:
-    volume (Tensor): The image tensor of shape (batch_size, depth, height, width)
-    diff1 (Tensor): Voxel value differences of shape (batch_size, depth - 1, height, width)
-    diff2 (Tensor): Voxel value differences of shape (batch_size, depth, height - 1, width)
-    diff3 (Tensor): Voxel value differences of shape (batch_size, depth, height, width - 1)
+    xsize (int): Size of the volume
+    indices (array): Voxel indices of shape (N, 3)
 
     Returns:
-    Tensor: The MSE-based smoothness loss.
+    Tuple: Position in values of the next voxel along each axis (N if it is not in indices) of shape
+    (3, N), mask of the voxels having a next voxel inside the volume of shape (3, N), and mask of the
+    voxels whose previous voxel is inside the volume but not in indices of shape (3, N).
     """
+    indices = np.asarray(indices, dtype=np.int64)
+    num_indices = indices.shape[0]
+    flat = (indices[:, 0] * xsize + indices[:, 1]) * xsize + indices[:, 2]
+    order = np.argsort(flat)
+    sorted_flat = flat[order]
+
+    def lookup(flat_ids):
+        pos = np.minimum(np.searchsorted(sorted_flat, flat_ids), num_indices - 1)
+        found = sorted_flat[pos] == flat_ids
+        return np.where(found, order[pos], num_indices), found
+
+    neighbours, next_mask, prev_mask = [], [], []
+    for axis, stride in enumerate([xsize * xsize, xsize, 1]):
+        coord = indices[:, axis]
+        has_next = coord < xsize - 1
+        has_prev = coord > 0
+        next_pos, next_found = lookup(flat + stride)
+        _, prev_found = lookup(flat - stride)
+        neighbours.append(np.where(has_next & next_found, next_pos, num_indices))
+        next_mask.append(has_next)
+        prev_mask.append(has_prev & ~prev_found)
+
+    return (tf.constant(np.stack(neighbours), dtype=tf.int32), tf.constant(np.stack(next_mask), dtype=tf.float32),
+            tf.constant(np.stack(prev_mask), dtype=tf.float32))
+
+
+def batch_scatter_nd(indices, values, shape):
+    """
+    Scatter a batch of values into a batch of grids with a single scatter_nd.
 
-    # Square differences
-    diff1 = tf.square(diff1)
-    diff2 = tf.square(diff2)
-    diff3 = tf.square(diff3)
+    Parameters:
+    indices (Tensor): Grid indices of shape (batch_size, N, D), or (N, D) if shared by the whole batch
+    values (Tensor): Values to scatter of shape (batch_size, N)
+    shape (list): Shape of each grid (D dimensions)
 
-    # Sum the squared differences
-    sum_axis = [1, 2, 3]
-    loss = tf.reduce_sum(diff1, axis=sum_axis) + tf.reduce_sum(diff2, axis=sum_axis) + tf.reduce_sum(diff3,
-                                                                                                     axis=sum_axis)
+    Returns:
+    Tensor: The scattered grids of shape (batch_size, *shape). Values at repeated indices are added.
+    """
+    batch_size = tf.shape(values)[0]
+    num_indices = tf.shape(values)[1]
+    indices = tf.cast(indices, tf.int32)
+    if indices.shape.rank == 2:
+        indices = tf.broadcast_to(indices[None, ...], [batch_size, num_indices, indices.shape[-1]])
 
-    # Normalize by the number of pixel pairs
-    num_pixel_pairs = tf.cast(2 * tf.reduce_prod(volume.shape[1:3]) - volume.shape[1] - volume.shape[2], tf.float32)
-    loss /= num_pixel_pairs
+    # Batch index prepended to the indices of each grid
+    batch_indices = tf.repeat(tf.range(batch_size)[:, None], num_indices, axis=1)[..., None]
+    indices = tf.concat([batch_indices, indices], axis=-1)
 
-    return loss
+    return tf.scatter_nd(indices, values, [batch_size] + list(shape))
 
 
-def densitySmoothnessVolume(xsize, indices, values):
-    grid = tf.zeros((1, xsize, xsize, xsize), dtype=tf.float32)
-    indices = tf.cast(indices[None, ...], dtype=tf.int32)
+@tf.function(jit_compile=True)
+def splat_images(coords, values, xsize):
+    """
+    Projects the values of a set of 2D coordinates onto a batch of images. Each value is weighted by
+    a Gaussian of its distance to the nearest pixel (so gradients flow back to the coordinates) and
+    accumulated with a single segment sum over the flat pixel ids of the batch. Compiled with XLA so the
+    rounding, weighting and id computation are fused also outside the jitted training step.
+
+    Args:
+    - coords: Pixel coordinates with shape (B, N, 2), in (column, row) order.
+    - values: Values to project with shape (B, N) or (1, N).
+    - xsize: Size of the images.
+
+    Returns:
+    - Batch of images with shape (B, xsize, xsize, 1).
+    """
+    batch_size = tf.shape(coords)[0]
+
+    # Nearest pixel and weight
+    bpos_round = tf.round(coords)
+    bpos_flow = tf.cast(bpos_round, tf.int32)
+    weight = tf.exp(-0.5 * tf.reduce_sum(tf.math.squared_difference(bpos_round, coords), axis=-1))
+
+    # Flat pixel ids (coordinates outside the images get a negative id and are dropped)
+    inside = tf.reduce_all(tf.logical_and(bpos_flow >= 0, bpos_flow < xsize), axis=-1)
+    pix_id = bpos_flow[..., 1] * xsize + bpos_flow[..., 0] + tf.range(batch_size)[:, None] * (xsize * xsize)
+    pix_id = tf.where(inside, pix_id, -tf.ones_like(pix_id))
+
+    # Scatter images
+    imgs = tf.math.unsorted_segment_sum(tf.reshape(values * weight, [-1]), tf.reshape(pix_id, [-1]),
+                                        batch_size * xsize * xsize)
+    return tf.reshape(imgs, [batch_size, xsize, xsize, 1])
 
-    # Scatter in volumes
-    fn = lambda inp: tf.tensor_scatter_nd_add(inp[0], inp[1], inp[2])
-    grid = tf.map_fn(fn, [grid, indices, values], fn_output_signature=tf.float32)
 
-    # Calculate the differences of neighboring pixel-values.
-    # The total variation loss is the sum of absolute differences of neighboring pixels
-    # in both dimensions.
-    pixel_diff1 = grid[:, 1:, :, :] - grid[:, :-1, :, :]
-    pixel_diff2 = grid[:, :, 1:, :] - grid[:, :, :-1, :]
-    pixel_diff3 = grid[:, :, :, 1:] - grid[:, :, :, :-1]
+@tf.function(jit_compile=True)
+def bilinear_splat_images(coords, values, xsize):
+    """
+    Projects the values of a set of 2D coordinates onto a batch of images, spreading each value over
+    its 2x2 neighbouring pixels with bilinear weights (so no extra smoothing of the images is needed).
+    All the contributions are accumulated with a single segment sum over the flat pixel ids of the batch.
+
+    Args:
+    - coords: Pixel coordinates with shape (B, N, 2), in (column, row) order.
+    - values: Values to project with shape (B, N) or (1, N).
+    - xsize: Size of the images.
+
+    Returns:
+    - Batch of images with shape (B, xsize, xsize, 1).
+    """
+    batch_size = tf.shape(coords)[0]
+
+    # Top-left pixel and bilinear weights of the 2x2 neighbourhood (B, N, 4)
+    bpos_floor = tf.floor(coords)
+    frac_x, frac_y = tf.unstack(coords - bpos_floor, axis=-1)
+    weights = tf.stack([(1. - frac_x) * (1. - frac_y), frac_x * (1. - frac_y),
+                        (1. - frac_x) * frac_y, frac_x * frac_y], axis=-1)
+    offsets = tf.constant([[0, 0], [1, 0], [0, 1], [1, 1]], dtype=tf.int32)
+    bpos_flow = tf.cast(bpos_floor, tf.int32)[:, :, None, :] + offsets[None, None, ...]
+
+    # Flat pixel ids (pixels outside the images get a negative id and are dropped)
+    inside = tf.reduce_all(tf.logical_and(bpos_flow >= 0, bpos_flow < xsize), axis=-1)
+    pix_id = bpos_flow[..., 1] * xsize + bpos_flow[..., 0] + tf.range(batch_size)[:, None, None] * (xsize * xsize)
+    pix_id = tf.where(inside, pix_id, -tf.ones_like(pix_id))
+
+    # Scatter images
+    imgs = tf.math.unsorted_segment_sum(tf.reshape(values[..., None] * weights, [-1]), tf.reshape(pix_id, [-1]),
+                                        batch_size * xsize * xsize)
+    return tf.reshape(imgs, [batch_size, xsize, xsize, 1])
+
+
+def densitySmoothnessVolume(xsize, neighbours, values):
+    """
+    Computes the Total Variation Loss and an MSE-based smoothness loss of a batch of volumes, without
+    scattering them in a dense grid. Both encourage spatial smoothness in the volume output (the MSE loss
+    penalizes large intensity differences between adjacent voxels).
+
+    Parameters:
+    xsize (int): Size of the volumes
+    neighbours (Tuple): Neighbour lookup tables, as returned by smoothness_neighbours
+    values (Tensor): Voxel values of shape (batch_size, N)
+
+    Returns:
+    Tuple: The total variation loss and the MSE-based smoothness loss of shape (batch_size,).
+    """
+    next_pos, next_mask, prev_mask = neighbours
+    values = tf.cast(values, tf.float32)
+
+    # Differences with the next voxel along each axis (voxels outside indices are zero)
+    values_padded = tf.pad(values, [[0, 0], [0, 1]])
+    diff_next = next_mask * (values[:, None, :] - tf.gather(values_padded, next_pos, axis=1))
+
+    # Differences with the previous voxel when it is not in indices (and therefore zero)
+    diff_prev = prev_mask * values[:, None, :]
+
+    # Sum of absolute and squared differences (single pass)
+    abs_next, abs_prev = tf.abs(diff_next), tf.abs(diff_prev)
+    tv_loss = tf.reduce_sum(abs_next + abs_prev, axis=[1, 2])
+    mse_loss = tf.reduce_sum(abs_next * abs_next + abs_prev * abs_prev, axis=[1, 2])
+
+    # Normalize by the volume size
+    tv_loss /= float(xsize ** 3)
 
-    # Compute total variation and density MSE losses
-    return (total_variation_loss(grid, pixel_diff1, pixel_diff2, pixel_diff3),
-            mse_smoothness_loss(grid, pixel_diff1, pixel_diff2, pixel_diff3))
+    # Normalize by the number of pixel pairs
+    mse_loss /= float(2 * xsize * xsize - 2 * xsize)
+
+    return tv_loss, mse_loss
 
 
 def connected_component_penalty(xsize, indices, values):
     threshold = tf.reduce_max(values)
 
-    grid = tf.zeros((1, xsize, xsize, xsize), dtype=tf.float32)
-    indices = tf.cast(indices[None, ...], dtype=tf.int32)
-
     # Scatter in volumes
-    fn = lambda inp: tf.tensor_scatter_nd_add(inp[0], inp[1], inp[2])
-    grid = tf.map_fn(fn, [grid, indices, values], fn_output_signature=tf.float32)[0, ..., None]
+    grid = batch_scatter_nd(indices, tf.cast(values, tf.float32), [xsize, xsize, xsize])[:1, ..., None]
 
     # Step 1: Threshold the prediction to get a binary mask
     binary_mask = tf.cast(grid > threshold, tf.float32)
 
-    # Step 2: Create 3D convolution filters to detect connected components
-    kernel = tf.constant(
-        [[[[[0.0, 1.0, 0.0],
-            [1.0, 1.0, 1.0],
-            [0.0, 1.0, 0.0]],
+    # Step 2: Count the face and edge neighbours (3x3x3 cube without corners and center) with
+    # separable 1D sums: cube sum - corners sum - center
+    def separable_sum(volume, taps):
+        taps = tf.constant(taps, dtype=tf.float32)
+        for shape in ([3, 1, 1, 1, 1], [1, 3, 1, 1, 1], [1, 1, 3, 1, 1]):
+            volume = tf.nn.conv3d(volume, tf.reshape(taps, shape), strides=[1, 1, 1, 1, 1], padding='SAME')
+        return volume
 
-           [[1.0, 1.0, 1.0],
-            [1.0, 0.0, 1.0],
-            [1.0, 1.0, 1.0]],
-
-           [[0.0, 1.0, 0.0],
-            [1.0, 1.0, 1.0],
-            [0.0, 1.0, 0.0]]]]], dtype=tf.float32)
-
-    # Apply the convolution to count neighbors
-    convolved = tf.nn.conv3d(binary_mask, kernel, strides=[1, 1, 1, 1, 1], padding='SAME')
+    convolved = (separable_sum(binary_mask, [1.0, 1.0, 1.0]) - separable_sum(binary_mask, [1.0, 0.0, 1.0])
+                 - binary_mask)
 
     # Step 3: Create a mask for isolated components (no neighbors)
     isolated_components = tf.cast(convolved < 1.5, tf.float32) * binary_mask
@@ -255,10 +425,14 @@ def diversity_loss(y_pred, alpha=1.0):
 
 def safe_acos(x):
     """
-    A safe version of tf.acos to avoid NaN values due to numerical issues.
-    Clips the input to be within the valid range [-1, 1].
+    A safe and fast version of tf.acos to avoid NaN values due to numerical issues.
+    Clips the input to be within the valid range [-1, 1] and evaluates the polynomial
+    approximation of Abramowitz & Stegun (4.4.45, absolute error below 7e-5 rad).
     """
-    return tf.acos(tf.clip_by_value(x, -1.0 + 1e-7, 1.0 - 1e-7))
+    x = tf.clip_by_value(x, -1.0 + 1e-7, 1.0 - 1e-7)
+    x_abs = tf.abs(x)
+    acos_abs = tf.sqrt(1.0 - x_abs) * (1.5707288 + x_abs * (-0.2121144 + x_abs * (0.0742610 - 0.0187293 * x_abs)))
+    return tf.where(x < 0.0, np.pi - acos_abs, acos_abs)
 
 
 def uniform_distribution_loss(vectors):
@@ -317,9 +491,8 @@ def correlation_coefficient_loss(y_true, y_pred):
 
 
 def l1_distance_norm(volumes, coords):
-    B = tf.shape(volumes)[0]
     total_mass = tf.reduce_sum(tf.abs(volumes), axis=1)
-    r = tf.tile(tf.reduce_sum(coords * coords, axis=1)[None, :], (B, 1))
+    r = tf.reduce_sum(coords * coords, axis=1)[None, :]
     l1_dist = tf.reduce_sum(tf.abs(r * volumes), axis=1)
     return 0.01 * l1_dist / (tf.cast(tf.shape(coords)[1], tf.float32) * total_mass)
 
@@ -336,17 +509,22 @@ class QuaternionLayer(tf.keras.layers.Layer):
 
 
 class CommonEncoder(Model):
-    def __init__(self, input_dim, architecture="convnn"):
+    def __init__(self, input_dim, architecture="convnn", fourier_resize=False):
         super(CommonEncoder, self).__init__()
         filters = create_blur_filters(10, 10, 30)
 
+        # Downsampling of the input images (antialiased spatial resampling unless the exact Fourier
+        # cropping is requested)
+        if fourier_resize:
+            resize = lambda y: resizeImageFourier(y, 64)
+        else:
+            resize = lambda y: tf.image.resize(y, [64, 64], method="bilinear", antialias=True)
+
         images = Input(shape=(input_dim, input_dim, 1))
 
         if architecture == "convnn":
 
-            x = tf.keras.layers.Reshape((input_dim, input_dim, 1))(images)
-
-            x = layers.Lambda(lambda y: resizeImageFourier(y, 64))(x)
+            x = layers.Lambda(resize)(images)
 
             x = layers.Lambda(lambda y: apply_blur_filters_to_batch(y, filters))(x)
 
@@ -377,15 +555,13 @@ class CommonEncoder(Model):
 
             b3_out = tf.keras.layers.Conv2D(512, 3, activation="relu", strides=(2, 2), padding="same")(b3_add)
             x = tf.keras.layers.Flatten()(b3_out)
-
-            x = layers.Flatten()(x)
             x = layers.Dense(1024, activation='relu')(x)
             for _ in range(3):
                 aux = layers.Dense(1024, activation='relu')(x)
                 x = layers.Add()([x, aux])
 
         elif architecture == "mlpnn":
-            x = layers.Lambda(lambda y: resizeImageFourier(y, 64))(images)
+            x = layers.Lambda(resize)(images)
             x = layers.Flatten()(x)
             x = layers.Dense(1024, activation='relu')(x)
             aux = layers.Dense(1024, activation='relu')(x)
@@ -400,44 +576,83 @@ class CommonEncoder(Model):
         encoded = self.encoder(x)
         return encoded
 
+
+class GroupedDense(tf.keras.layers.Layer):
+    def __init__(self, groups, units, activation=None, kernel_initializer=None, bias_initializer="zeros", **kwargs):
+        """
+        Stack of independent Dense layers evaluated with a single batched matmul.
+        Args:
+            groups: number of independent Dense layers
+            units: output units of each Dense layer
+            kernel_initializer: defaults to Glorot uniform computed per group
+        """
+        super(GroupedDense, self).__init__(**kwargs)
+        self.groups = groups
+        self.units = units
+        self.activation = tf.keras.activations.get(activation)
+        self.kernel_initializer = kernel_initializer
+        self.bias_initializer = bias_initializer
+
+    def build(self, input_shape):
+        input_dim = int(input_shape[-1])
+        kernel_initializer = self.kernel_initializer
+        if kernel_initializer is None:
+            limit = np.sqrt(6. / (input_dim + self.units))
+            kernel_initializer = RandomUniform(-limit, limit)
+        self.kernel = self.add_weight(name="kernel", shape=(self.groups, input_dim, self.units),
+                                      initializer=kernel_initializer, trainable=True)
+        self.bias = self.add_weight(name="bias", shape=(self.groups, self.units),
+                                    initializer=self.bias_initializer, trainable=True)
+
+    def call(self, inputs):
+        # Shared input (B, I) or one input per group (B, G, I)
+        if inputs.shape.rank == 2:
+            outputs = tf.einsum("bi,gij->bgj", inputs, self.kernel)
+        else:
+            outputs = tf.einsum("bgi,gij->bgj", inputs, self.kernel)
+        return self.activation(outputs + self.bias)
+
+
 class HeadEncoder(Model):
-    def __init__(self, refinement=False, suffix="1", useQuaternions=False):
+    def __init__(self, refinement=False, n_candidates=6, useQuaternions=False):
         super(HeadEncoder, self).__init__()
         if useQuaternions:
             bias_values = np.array([1.0, 0.0, 0.0, 0.0], dtype=np.float32)
         else:
             bias_values = np.array([1.0, 0.0, 0.0, 0.0, 1.0, 0.0], dtype=np.float32)
+        rows_dim = bias_values.size
+
+        # Output layers are padded to 8 units (Tensor Core friendly GEMMs) and sliced afterwards
+        bias_values = np.pad(bias_values, (0, 8 - rows_dim))
+        bias_values = np.tile(bias_values[None, :], (n_candidates, 1))
 
         x = Input(shape=(1024,))
 
-        rows = layers.Dense(1024, activation="relu")(x)
+        # All the candidate heads are evaluated at once (B, n_candidates, units)
+        rows = GroupedDense(n_candidates, 1024, activation="relu")(x)
         for _ in range(3):
-            rows = layers.Dense(1024, activation="relu")(rows)
+            rows = GroupedDense(n_candidates, 1024, activation="relu")(rows)
         if refinement:
-            if useQuaternions:
-                rows = layers.Dense(4, activation="linear", kernel_initializer=Zeros(),
-                                    bias_initializer=Constant(bias_values))(rows)
-                rows = QuaternionLayer()(rows)
-            else:
-                rows = layers.Dense(6, activation="linear", kernel_initializer=Zeros(),
-                                    bias_initializer=Constant(bias_values))(rows)
+            rows = GroupedDense(n_candidates, 8, activation="linear", kernel_initializer=Zeros(),
+                                bias_initializer=Constant(bias_values))(rows)
         else:
-            if useQuaternions:
-                rows = layers.Dense(4, activation="linear")(rows)
-                rows = QuaternionLayer()(rows)
-            else:
-                rows = layers.Dense(6, activation="linear")(rows)
+            rows = GroupedDense(n_candidates, 8, activation="linear")(rows)
+        rows = layers.Lambda(lambda y: y[..., :rows_dim])(rows)
+        if useQuaternions:
+            rows = QuaternionLayer()(rows)
 
-        shifts = layers.Dense(1024, activation="relu")(x)
+        shifts = GroupedDense(n_candidates, 1024, activation="relu")(x)
         for _ in range(3):
-            shifts = layers.Dense(1024, activation="relu")(shifts)
-        shifts = layers.Dense(2, activation="linear", kernel_initializer=RandomNormal(stddev=0.0001))(shifts)
+            shifts = GroupedDense(n_candidates, 1024, activation="relu")(shifts)
+        shifts = GroupedDense(n_candidates, 8, activation="linear",
+                              kernel_initializer=RandomNormal(stddev=0.0001))(shifts)
+        shifts = layers.Lambda(lambda y: y[..., :2])(shifts)
 
         self.encoder = tf.keras.Model(x, [rows, shifts])
 
     def call(self, x):
-        encoded = self.encoder(x)
-        return encoded
+        rows, shifts = self.encoder(x)
+        return tf.cast(rows, tf.float32), tf.cast(shifts, tf.float32)
 
 
 class HetEncoder(Model):
@@ -476,8 +691,6 @@ class HetEncoder(Model):
 
         b3_out = layers.Conv2D(16, 3, activation="relu", strides=(2, 2), padding="same")(b3_add)
         x = layers.Flatten()(b3_out)
-
-        x = layers.Flatten()(x)
         for _ in range(4):
             x = layers.Dense(256, activation='relu')(x)
         x = layers.Dense(latDim, activation="linear")(x)
@@ -491,7 +704,7 @@ class HetEncoder(Model):
 
     def call(self, x):
         encoded = self.encoder(x)
-        return encoded
+        return tf.cast(encoded, tf.float32)
 
 
 class Decoder(Model):
@@ -501,6 +714,9 @@ class Decoder(Model):
 
         coords = Input(shape=(total_voxels, 3,))
 
+        # Output width padded to a multiple of 8 (Tensor Core friendly GEMMs)
+        padded_voxels = 8 * int(np.ceil(total_voxels / 8))
+
         # Volume decoder
         delta_vol = layers.Flatten()(coords)
         delta_vol = layers.Dense(10, activation=Sine(w0=1.0),
@@ -509,15 +725,16 @@ class Decoder(Model):
             delta_vol = layers.Dense(10, activation=Sine(w0=1.0),
                                      kernel_initializer=SIRENInitializer(c=1.0))(delta_vol)
         if not only_pos:
-            delta_vol = layers.Dense(total_voxels, activation='linear')(delta_vol)  # If input volume, give near zero init?
+            delta_vol = layers.Dense(padded_voxels, activation='linear')(delta_vol)  # If input volume, give near zero init?
         else:
-            delta_vol = layers.Dense(total_voxels, activation='relu')(delta_vol)  # For classes works fine
+            delta_vol = layers.Dense(padded_voxels, activation='relu')(delta_vol)  # For classes works fine
+        delta_vol = layers.Lambda(lambda y: y[:, :total_voxels])(delta_vol)
 
         self.decoder = tf.keras.Model(coords, delta_vol)
 
     def call(self, x):
         decoded = self.decoder(x)
-        return decoded
+        return tf.cast(decoded, tf.float32)
 
 
 class HetDecoder(Model):
@@ -532,29 +749,31 @@ class HetDecoder(Model):
             aux = layers.Dense(num_neurons, activation=Sine(1.0),
                                kernel_initializer=SIRENInitializer())(latent)
             delta_het = layers.Add()([delta_het, aux])
-        delta_het = layers.Dense(generator.total_voxels, activation="linear",
+        delta_het = layers.Dense(8 * int(np.ceil(generator.total_voxels / 8)), activation="linear",
                                  kernel_initializer=RandomUniform(-1e-5, 1e-5))(delta_het)
+        delta_het = layers.Lambda(lambda y: y[:, :generator.total_voxels])(delta_het)
 
         self.delta_decoder = tf.keras.Model(latent, delta_het)
 
     def call(self, inputs):
         delta = self.delta_decoder(inputs)
-        return delta
+        return tf.cast(delta, tf.float32)
 
 
 class AutoEncoder(Model):
     def __init__(self, generator, architecture="convnn", CTF="wiener",
                  l1_lambda=0.1, multires=None, tv_lambda=0.5, mse_lambda=0.5,
                  ud_lambda=0.000001, un_lambda=0.0001, useQuaternions=False,
-                 only_pos=True, only_pose=False, n_candidates=6, useHet=False, latDim=8, **kwargs):
+                 only_pos=True, only_pose=False, n_candidates=6, useHet=False, latDim=8, fourier_resize=False,
+                 cache_ctf=False, bilinear_splat=False, **kwargs):
         super(AutoEncoder, self).__init__(**kwargs)
         self.CTF = CTF if generator.applyCTF == 1 else None
         self.applyCTF = bool(generator.applyCTF)
         self.multires = multires
         self.useHet = useHet
         self.useQuaternions = useQuaternions
-        self.common_encoder = CommonEncoder(generator.xsize, architecture=architecture)
-        self.head_encoder = [HeadEncoder(generator.refinement, suffix=str(idx + 1), useQuaternions=useQuaternions) for idx in range(n_candidates)]
+        self.common_encoder = CommonEncoder(generator.xsize, architecture=architecture, fourier_resize=fourier_resize)
+        self.head_encoder = HeadEncoder(generator.refinement, n_candidates=n_candidates, useQuaternions=useQuaternions)
         if self.useHet:
             self.het_encoder = HetEncoder(generator.xsize, latDim=latDim)
             self.het_decoder = HetDecoder(generator, latDim=latDim)
@@ -569,6 +788,23 @@ class AutoEncoder(Model):
             self.filters = None
         else:
             self.filters = create_blur_filters(multires, 10, 30)
+        if bilinear_splat:
+            # Bilinear splatting already smooths the projections (no Gaussian filter)
+            self.splat_images = bilinear_splat_images
+            self.gaussian_transfer = 1.0
+        else:
+            self.splat_images = splat_images
+            self.gaussian_kernels = gaussian_filter_kernels(3, 1)
+            self.gaussian_transfer = gaussian_filter_transfer(3, 1, generator.pad_factor * generator.xsize)
+
+        # Projection filtering (Gaussian filter and CTF fused in Fourier space when the CTF is applied)
+        if self.applyCTF:
+            self.filter_projections = generator.ctfFilterImage
+        elif bilinear_splat:
+            self.filter_projections = lambda imgs, ctf: imgs
+        else:
+            self.filter_projections = lambda imgs, ctf: separable_gaussian_filter(imgs, self.gaussian_kernels)
+        self.volume_kernel = gaussian_filter_kernels(9, 1)[0]
 
         self.generator = generator
         self.xsize = generator.xsize
@@ -583,6 +819,16 @@ class AutoEncoder(Model):
             self.cost = correlation_coefficient_loss
         else:
             self.cost = self.generator.mse
+        self.coords = tf.constant(generator.coords, dtype=tf.float32)
+        self.coords_scaled = generator.scale_factor * self.coords
+        self.smoothness_neighbours = smoothness_neighbours(generator.xsize, generator.indices)
+        self.values_bcast = tf.constant(generator.values, dtype=tf.float32)[None, :]
+        self.batch_params = tf.stack([generator.angle_rot, generator.angle_tilt, generator.angle_psi,
+                                      generator.shift_x, generator.shift_y, generator.defocusU,
+                                      generator.defocusV, generator.defocusAngle, generator.cs], axis=1)
+        self.ctf_table = self.build_ctf_table() if cache_ctf and self.applyCTF else None
+        self.gather_batch = tf.function(jit_compile=True)(self.gather_batch)
+        self.decode_images_with_loss = tf.function(jit_compile=True)(self.decode_images_with_loss)
         self.rec_loss_tracker = tf.keras.metrics.Mean(name="rec_loss")
         self.het_rec_loss_tracker = tf.keras.metrics.Mean(name="het_rec_loss")
 
@@ -593,152 +839,185 @@ class AutoEncoder(Model):
             self.het_rec_loss_tracker,
         ]
 
+    def compute_ctf(self, ctf_params):
+        # Batch CTFs from the (defocusU, defocusV, defocusAngle, cs) columns of the batch parameters
+        defocusU_batch, defocusV_batch, defocusAngle_batch, cs_batch = tf.unstack(ctf_params, axis=1)
+        kv_batch = self.generator.kv
+        return computeCTF(defocusU_batch, defocusV_batch, defocusAngle_batch, cs_batch, kv_batch,
+                          self.generator.sr, self.generator.pad_factor,
+                          [self.generator.xsize, int(0.5 * self.generator.xsize + 1)],
+                          tf.shape(ctf_params)[0], self.generator.applyCTF)
+
+    def build_ctf_table(self, chunk_size=1024):
+        # CTFs of the whole dataset, computed in chunks (float16 to halve memory). computeCTF also shifts the
+        # particle axis, so each chunk is unshifted to keep the table in particle order
+        num_particles = self.batch_params.shape[0]
+        return tf.concat([tf.cast(tf.signal.ifftshift(self.compute_ctf(self.batch_params[idx:idx + chunk_size, 5:]),
+                                                      axes=0), tf.float16)
+                          for idx in range(0, num_particles, chunk_size)], axis=0)
+
+    def gather_batch(self, indexes):
+        # Gather all the alignment and CTF parameters of the batch at once
+        batch_params = tf.gather(self.batch_params, indexes, axis=0)
+        rot_batch, tilt_batch, psi_batch, shift_x_batch, shift_y_batch = tf.unstack(batch_params[:, :5], axis=1)
+        shifts_batch = tf.stack([shift_x_batch, shift_y_batch], axis=1)
+
+        # Batch CTFs (precomputed or computed on the fly)
+        if self.ctf_table is not None:
+            # Same particle axis shift as computeCTF (matching the one applied to the images by fft_pad)
+            ctf = tf.cast(tf.gather(self.ctf_table, indexes, axis=0), tf.float32)
+            ctf = tf.signal.fftshift(ctf, axes=0)
+        else:
+            ctf = self.compute_ctf(batch_params[:, 5:])
+
+        return rot_batch, tilt_batch, psi_batch, shifts_batch, ctf
+
     def prepare_batch(self, indexes):
-        # Update batch_size (in case it is incomplete)
-        batch_size_scope = tf.shape(indexes)[0]
+        rot_batch, tilt_batch, psi_batch, shifts_batch, ctf = self.gather_batch(indexes)
 
         if self.generator.refinement:
             # Precompute batch alignments
-            self.generator.rot_batch = tf.gather(self.generator.angle_rot, indexes, axis=0)
-            self.generator.tilt_batch = tf.gather(self.generator.angle_tilt, indexes, axis=0)
-            self.generator.psi_batch = tf.gather(self.generator.angle_psi, indexes, axis=0)
+            self.generator.rot_batch = rot_batch
+            self.generator.tilt_batch = tilt_batch
+            self.generator.psi_batch = psi_batch
 
             # Precompute shifts
-            shifts_x = tf.gather(self.generator.shifts[0], indexes, axis=0)
-            shifts_y = tf.gather(self.generator.shifts[1], indexes, axis=0)
-            self.generator.shifts_batch = tf.stack([shifts_x, shifts_y], axis=1)
+            self.generator.shifts_batch = shifts_batch
 
         # Precompute batch CTFs
-        defocusU_batch = tf.gather(self.generator.defocusU, indexes, axis=0)
-        defocusV_batch = tf.gather(self.generator.defocusV, indexes, axis=0)
-        defocusAngle_batch = tf.gather(self.generator.defocusAngle, indexes, axis=0)
-        cs_batch = tf.gather(self.generator.cs, indexes, axis=0)
-        kv_batch = self.generator.kv
-        ctf = computeCTF(defocusU_batch, defocusV_batch, defocusAngle_batch, cs_batch, kv_batch,
-                         self.generator.sr, self.generator.pad_factor,
-                         [self.generator.xsize, int(0.5 * self.generator.xsize + 1)],
-                         batch_size_scope, self.generator.applyCTF)
         self.generator.ctf = ctf
 
+        return rot_batch, tilt_batch, psi_batch, shifts_batch, ctf
+
     def compile(self, e_optimizer, d_optimizer, het_optimizer, jit_compile=False):
         super().compile(jit_compile=jit_compile)
         self.e_optimizer = e_optimizer
         self.d_optimizer = d_optimizer
         self.het_optimizer = het_optimizer
 
-    def decode_images_with_loss(self, images, images_corrected):
-        B = tf.shape(images)[0]
-
+    def load_weights(self, filepath, *args, **kwargs):
+        try:
+            return super(AutoEncoder, self).load_weights(filepath, *args, **kwargs)
+        except ValueError:
+            # Models saved with one HeadEncoder per candidate or without padded output layers
+            if not h5py.is_hdf5(filepath):
+                raise
+            self.load_legacy_weights(filepath)
+
+    def load_legacy_weights(self, filepath):
+        # The kernels of the old per candidate heads are stacked into the GroupedDense kernels and unpadded
+        # output layers are zero padded (their extra units are sliced away). Legacy HDF5 files only
+        saved_weights = read_h5_weights(filepath)
+        weight_values, idx = [], 0
+        for layer in [layer for layer in self.layers if layer.weights]:
+            if idx >= len(saved_weights):
+                raise ValueError("Layer count mismatch when loading the weights saved in %s" % filepath)
+            layer_weights = layer.trainable_weights + layer.non_trainable_weights
+            if isinstance(layer, HeadEncoder) and saved_weights[idx][0].ndim == 2:
+                heads = saved_weights[idx:idx + self.n_candidates]
+                values = [np.stack(head_values, axis=0) for head_values in zip(*heads)]
+                idx += self.n_candidates
+            else:
+                values = saved_weights[idx]
+                idx += 1
+            if len(values) != len(layer_weights):
+                raise ValueError("Weights of layer %s do not match the ones saved in %s" % (layer.name, filepath))
+            for weight, value in zip(layer_weights, values):
+                shape = tuple(weight.shape.as_list())
+                if value.shape[:-1] == shape[:-1] and shape[-1] == 8 * int(np.ceil(value.shape[-1] / 8)):
+                    value = np.pad(value, [(0, 0)] * (value.ndim - 1) + [(0, shape[-1] - value.shape[-1])])
+                weight_values.append((weight, value))
+        if idx != len(saved_weights):
+            raise ValueError("Layer count mismatch when loading the weights saved in %s" % filepath)
+        tf.keras.backend.batch_set_value(weight_values)
+
+    def decode_images_with_loss(self, images, images_corrected, rot_batch, tilt_batch, psi_batch, shifts_batch, ctf):
         # Original coordinates
-        o = tf.constant(self.generator.coords, dtype=tf.float32)[None, ...]
-        prev_loss_rec = 10000. * tf.ones(B)
+        o = self.coords[None, ...]
+        losses_rec = []
         u_norm_loss = 0.0
         uniform_dist_loss = 0.0
 
-        keep_r = tf.zeros((B, 3, 3), dtype=tf.float32)
-        keep_shifts = tf.zeros((B, 2), dtype=tf.float32)
-
         encoded = self.common_encoder(images_corrected)
 
-        # Consensus volume decoder
+        # Consensus volume decoder and image values (shared by all candidates and symmetries)
         if not self.only_pose:
             delta = self.decoder_delta(o)
+            values_cons = self.values_bcast + delta
         else:
             delta = 0.0
+            values_cons = self.values_bcast
 
-        # Coordinates with batch dimension
-        o = self.generator.scale_factor * tf.tile(o, (B, 1, 1))
-
-        for idr in range(self.n_candidates):
-            rows, shifts = self.head_encoder[idr](encoded)
-
-            # Compute rotation matrix
-            if self.useQuaternions:
-                r_no_sym = quaternion_to_rotation_matrix(rows)
-            else:
-                r_no_sym = gramSchmidt(rows)
-
-            if self.generator.refinement:
-                shifts = shifts + self.generator.shifts_batch
-
-            # Symmetry loop
-            loss_rec = 0.0
-            for iSym in range(self.generator.noSym):
-                # Prepare symmetry matrix
-                R = tf.tile(self.generator.sym_matrices[iSym][None, ...], (B, 1, 1))
-
-                # Apply symmetrix matrix
-                r = tf.matmul(r_no_sym, tf.transpose(R, perm=[0, 2, 1]))
-
-                if self.generator.refinement:
-                    r_o = euler_matrix_batch(self.generator.rot_batch, self.generator.tilt_batch, self.generator.psi_batch)
-                    r_o = tf.stack(r_o, axis=1)
-                    r_o = tf.matmul(r_o, tf.transpose(R, perm=[0, 2, 1]))
-                    r = tf.matmul(r, r_o)
-
-                # Get rotated coords
-                ro = tf.matmul(o, tf.transpose(r, perm=[0, 2, 1]))
-
-                # Get XY coords
-                ro = ro[..., :-1]
+        # Symmetry copies of the batch (B * S)
+        noSym = self.generator.noSym
+        images_sym = tf.repeat(images, noSym, axis=0)
+        if self.applyCTF:
+            # The CTF batch axis carries the B // 2 particle shift of computeCTF, while fft_pad shifts the B * S
+            # projections by (B * S) // 2, so the copies are made in particle order and shifted again
+            ctf_sym = tf.repeat(tf.signal.ifftshift(ctf * self.gaussian_transfer, axes=0), noSym, axis=0)
+            ctf_sym = tf.cast(tf.signal.fftshift(ctf_sym, axes=0), tf.complex64)
+        else:
+            ctf_sym = None
+        if self.multires is not None:
+            filt_images = tf.repeat(apply_blur_filters_to_batch(images_corrected, self.filters), noSym, axis=0)
 
-                # Apply shifts
-                ro = ro - (shifts[:, None, :]) + self.generator.xmipp_origin[0]
+        # All candidate poses at once (B, n_candidates, ...)
+        rows_candidates, shifts_candidates = self.head_encoder(encoded)
 
-                # Permute coords
-                ro = tf.stack([ro[..., 1], ro[..., 0]], axis=-1)
+        # Rotation matrices of all the candidates at once (B, n_candidates, 3, 3)
+        rows_flat = tf.reshape(rows_candidates, [-1, rows_candidates.shape[-1]])
+        if self.useQuaternions:
+            r_candidates = quaternion_to_rotation_matrix(rows_flat)
+        else:
+            r_candidates = gramSchmidt(rows_flat)
+        r_candidates = tf.reshape(r_candidates, [-1, self.n_candidates, 3, 3])
 
-                # Initialize images
-                imgs = tf.zeros((B, self.generator.xsize, self.generator.xsize), dtype=tf.float32)
+        # Image origin minus the shifts of all the candidates (B, n_candidates, 2)
+        if self.generator.refinement:
+            shifts_candidates = shifts_candidates + shifts_batch[:, None, :]
+        origin_candidates = self.generator.xmipp_origin[0] - shifts_candidates
 
-                # Image values
-                original_values = tf.tile(self.generator.values[None, :], (B, 1))
-                values = tf.cast(original_values, tf.float32) + delta
+        # Prior alignment with all symmetry matrices applied (B, S, 3, 3)
+        if self.generator.refinement:
+            r_o = euler_matrix_batch(rot_batch, tilt_batch, psi_batch)
+            r_o = tf.stack(r_o, axis=1)
+            r_o = tf.einsum('bij,skj->bsik', r_o, self.generator.sym_matrices)
 
-                # Backprop through coords
-                bpos_round = tf.round(ro)
-                bpos_flow = tf.cast(bpos_round, tf.int32)
-                num = tf.reduce_sum(((bpos_round - ro) ** 2.), axis=-1)
-                weight = tf.exp(-num / (2. * 1. ** 2.))
-                values = values * weight
+        for idr in range(self.n_candidates):
+            rows, r_no_sym = rows_candidates[:, idr], r_candidates[:, idr]
 
-                # Scatter images
-                fn = lambda inp: tf.tensor_scatter_nd_add(inp[0], inp[1], inp[2])
-                imgs = tf.map_fn(fn, [imgs, bpos_flow, values], fn_output_signature=tf.float32)
+            # Apply all symmetry matrices at once (B, S, 3, 3)
+            r = tf.einsum('bij,skj->bsik', r_no_sym, self.generator.sym_matrices)
 
-                # Reshape images
-                imgs = tf.reshape(imgs, [-1, self.xsize, self.xsize, 1])
+            if self.generator.refinement:
+                r = tf.matmul(r, r_o)
 
-                # Gaussian filtering
-                imgs = tfa.image.gaussian_filter2d(imgs, 3, 1)
+            # Get rotated XY coords (B, S, N, 2) (only the first two rows of r are needed)
+            ro = tf.einsum('nd,bsed->bsne', self.coords_scaled, r[..., :2, :])
 
-                # CTF corruption
-                if self.applyCTF:
-                    imgs = self.generator.ctfFilterImage(imgs)
+            # Apply shifts
+            ro = ro + origin_candidates[:, idr, None, None, :]
 
-                # Image loss
-                loss_rec += self.cost(images, imgs)
+            # Move symmetries to the batch dimension (B * S, N, 2)
+            ro = tf.reshape(ro, [-1, self.coords_scaled.shape[0], 2])
 
-                if self.multires is not None:
-                    filt_images = apply_blur_filters_to_batch(images_corrected, self.filters)
-                    filt_decoded = apply_blur_filters_to_batch(imgs, self.filters)
-                    for idx in range(self.multires):
-                        loss_rec += 0.001 * self.cost(filt_images[..., idx], filt_decoded[..., idx])
+            # Scatter images (backprop through coords)
+            imgs = self.splat_images(ro, values_cons, self.generator.xsize)
 
-            loss_rec /= self.generator.noSym
+            # Gaussian filtering and CTF corruption
+            imgs = self.filter_projections(imgs, ctf_sym)
 
-            # Preparing indexing for "winner's takes it all"
-            mask = tf.less_equal(loss_rec, prev_loss_rec)  # Shape: (B,)
-            mask_shape_r = tf.concat([tf.shape(mask), tf.ones(2, dtype=tf.int32)], axis=0)
-            mask_shape_shifts = tf.concat([tf.shape(mask), tf.ones(1, dtype=tf.int32)], axis=0)
-            mask_r = tf.reshape(mask, mask_shape_r)
-            mask_shifts = tf.reshape(mask, mask_shape_shifts)
+            # Image loss
+            loss_rec = self.cost(images_sym, imgs)
 
-            # Minimum indexing
-            keep_r = tf.where(mask_r, r_no_sym, keep_r)
-            keep_shifts = tf.where(mask_shifts, shifts, keep_shifts)
+            if self.multires is not None:
+                filt_decoded = apply_blur_filters_to_batch(imgs, self.filters)
+                for idx in range(self.multires):
+                    loss_rec += 0.001 * self.cost(filt_images[..., idx], filt_decoded[..., idx])
 
-            loss_rec = tf.reduce_min(tf.stack([loss_rec, prev_loss_rec], axis=-1), axis=-1)
+            # Average over symmetries
+            loss_rec = tf.reduce_sum(tf.reshape(loss_rec, [-1, noSym]), axis=1) / noSym
+            losses_rec.append(loss_rec)
 
             # Unit norm constrain
             if self.useQuaternions:
@@ -749,36 +1028,39 @@ class AutoEncoder(Model):
                 x = (0.5 * (tf.reduce_mean(n1) + tf.reduce_mean(n2)))
             u_norm_loss += x
 
-            # Uniform distribution loss
-            z_vec = tf.tile(tf.constant([0, 0, 1], tf.float32)[None, None, :], (B, 1, 1))
-            r_z_vec = tf.squeeze(tf.matmul(z_vec, tf.transpose(r_no_sym, perm=[0, 2, 1])))
+            # Uniform distribution loss (rotated Z axis, i.e. the last column of r)
+            r_z_vec = r_no_sym[..., 2]
             x = uniform_distribution_loss(r_z_vec)
             uniform_dist_loss += x
 
-            # Keep best loss
-            prev_loss_rec = loss_rec
+        # "Winner's takes it all" (best candidate of each image)
+        losses_rec = tf.stack(losses_rec, axis=1)  # Shape: (B, n_candidates)
+        best = tf.argmin(losses_rec, axis=1)
+        keep_r = tf.gather(r_candidates, best, batch_dims=1)
+        keep_shifts = tf.gather(shifts_candidates, best, batch_dims=1)
+        loss_rec = tf.reduce_min(losses_rec, axis=1)
 
         u_norm_loss = u_norm_loss / self.n_candidates
         uniform_dist_loss = uniform_dist_loss / self.n_candidates
 
         # L1 penalization delta_het
-        values = delta + self.generator.values[None, :]
+        values = values_cons
         l1_loss = tf.reduce_mean(tf.reduce_sum(tf.abs(values), axis=1))
         l1_loss = self.l1_lambda * l1_loss / self.generator.total_voxels
-        l1_dist_loss = l1_distance_norm(values, tf.constant(self.generator.coords, tf.float32))
+        l1_dist_loss = l1_distance_norm(values, self.coords)
         l1_loss += self.l1_lambda * l1_dist_loss
 
         # Total variation and MSE losses
         tv_loss, d_mse_loss = densitySmoothnessVolume(self.generator.xsize,
-                                                      self.generator.indices, values)
+                                                      self.smoothness_neighbours, values)
         tv_loss *= self.tv_lambda
         d_mse_loss *= self.mse_lambda
 
-        # Negative loss
+        # Negative loss (mean of the negative values, without dynamic shapes)
         if not self.only_pos:
-            mask = tf.less(values, 0.0)
-            delta_neg = tf.boolean_mask(values, mask)
-            delta_neg = tf.reduce_mean(tf.abs(tf.cast(delta_neg, tf.float32)), keepdims=True)
+            delta_neg = tf.nn.relu(-values)
+            num_neg = tf.reduce_sum(tf.cast(tf.less(values, 0.0), tf.float32))
+            delta_neg = tf.reduce_sum(delta_neg)[None] / tf.maximum(num_neg, 1.0)
             neg_loss = tf.cast(self.only_pos, tf.float32) * self.l1_lambda * delta_neg
 
         else:
@@ -791,18 +1073,10 @@ class AutoEncoder(Model):
         return loss_rec, keep_r, keep_shifts, delta
 
     def decode_images_het_with_loss(self, images, images_corrected, r_no_sym, shifts, delta):
-        B = tf.shape(images)[0]
-
-        # Original coordinates
-        o = tf.constant(self.generator.coords, dtype=tf.float32)[None, ...]
-
         # Heterogeneous volume decoder
         het = self.het_encoder(images_corrected)
         delta_het = self.het_decoder(het)
 
-        # Coordinates with batch dimension
-        o = self.generator.scale_factor * tf.tile(o, (B, 1, 1))
-
         if self.generator.refinement:
             shifts = shifts + self.generator.shifts_batch
 
@@ -819,45 +1093,21 @@ class AutoEncoder(Model):
         #     # r_het = tf.matmul(r_het, tf.transpose(R, perm=[0, 2, 1]))
         #     r = tf.matmul(r_het, r)
 
-        # Get rotated coords
-        ro = tf.matmul(o, tf.transpose(r_no_sym, perm=[0, 2, 1]))
-
-        # Get XY coords
-        ro = ro[..., :-1]
+        # Get rotated XY coords (only the first two rows of r are needed)
+        ro = tf.einsum('nd,bed->bne', self.coords_scaled, r_no_sym[..., :2, :])
 
         # Apply shifts
         ro = ro - (shifts[:, None, :]) + self.generator.xmipp_origin[0]
 
-        # Permute coords
-        ro = tf.stack([ro[..., 1], ro[..., 0]], axis=-1)
-
-        # Initialize images
-        imgs_with_het = tf.zeros((B, self.generator.xsize, self.generator.xsize), dtype=tf.float32)
-
         # Image values
-        original_values = tf.tile(self.generator.values[None, :], (B, 1))
-        values_with_het = tf.cast(original_values, tf.float32) + delta_het
+        values_with_het = self.values_bcast + delta_het
 
-        # Backprop through coords
-        bpos_round = tf.round(ro)
-        bpos_flow = tf.cast(bpos_round, tf.int32)
-        num = tf.reduce_sum(((bpos_round - ro) ** 2.), axis=-1)
-        weight = tf.exp(-num / (2. * 1. ** 2.))
-        values_with_het = values_with_het * weight
+        # Scatter images (backprop through coords)
+        imgs_with_het = self.splat_images(ro, values_with_het, self.generator.xsize)
 
-        # Scatter images
-        fn = lambda inp: tf.tensor_scatter_nd_add(inp[0], inp[1], inp[2])
-        imgs_with_het = tf.map_fn(fn, [imgs_with_het, bpos_flow, values_with_het], fn_output_signature=tf.float32)
-
-        # Reshape images
-        imgs_with_het = tf.reshape(imgs_with_het, [-1, self.xsize, self.xsize, 1])
-
-        # Gaussian filtering
-        imgs_with_het = tfa.image.gaussian_filter2d(imgs_with_het, 3, 1)
-
-        # CTF corruption
-        if self.applyCTF:
-            imgs_with_het = self.generator.ctfFilterImage(imgs_with_het)
+        # Gaussian filtering and CTF corruption
+        ctf = self.generator.ctf * self.gaussian_transfer if self.applyCTF else None
+        imgs_with_het = self.filter_projections(imgs_with_het, ctf)
 
         loss_rec_with_het = self.cost(images, imgs_with_het)
 
@@ -868,15 +1118,15 @@ class AutoEncoder(Model):
                 loss_rec_with_het += 0.001 * self.cost(filt_images[..., idx], filt_decoded[..., idx])
 
         # L1 penalization delta_het
-        values_het = delta + self.generator.values[None, :] + delta_het
+        values_het = delta + self.values_bcast + delta_het
         l1_loss_het = tf.reduce_mean(tf.reduce_sum(tf.abs(values_het), axis=1))
         l1_loss_het = self.l1_lambda * l1_loss_het / self.generator.total_voxels
-        l1_dist_loss = l1_distance_norm(values_het, tf.constant(self.generator.coords, tf.float32))
+        l1_dist_loss = l1_distance_norm(values_het, self.coords)
         l1_loss_het += self.l1_lambda * l1_dist_loss
 
         # Total variation and MSE losses
         tv_loss_het, d_mse_loss_het = densitySmoothnessVolume(self.generator.xsize,
-                                                              self.generator.indices, values_het)
+                                                              self.smoothness_neighbours, values_het)
         tv_loss_het *= self.tv_lambda
         d_mse_loss_het *= self.mse_lambda
 
@@ -895,7 +1145,7 @@ class AutoEncoder(Model):
         images = data[0]
 
         # Prepare batch
-        self.prepare_batch(data[1])
+        batch_params = self.prepare_batch(data[1])
 
         # Wiener filter
         if self.applyCTF:
@@ -905,12 +1155,10 @@ class AutoEncoder(Model):
 
         # Encoder tape
         with tf.GradientTape() as tape_e:
-            loss_rec_e, r_no_sym, shifts, delta = self.decode_images_with_loss(images, images_corrected)
+            loss_rec_e, r_no_sym, shifts, delta = self.decode_images_with_loss(images, images_corrected, *batch_params)
 
         # Get weights encoder + pose + shifts + het
-        encoder_weights = self.common_encoder.trainable_weights
-        for model in self.head_encoder:
-            encoder_weights += model.trainable_weights
+        encoder_weights = self.common_encoder.trainable_weights + self.head_encoder.trainable_weights
 
         # Gradients
         if self.only_pose:
@@ -957,7 +1205,7 @@ class AutoEncoder(Model):
         images = data[0]
 
         # Prepare batch
-        self.prepare_batch(data[1])
+        batch_params = self.prepare_batch(data[1])
 
         # Wiener filter
         if self.applyCTF:
@@ -966,7 +1214,7 @@ class AutoEncoder(Model):
             images_corrected = images
 
         # Encoder
-        loss_rec_e, r_no_sym, shifts, delta = self.decode_images_with_loss(images, images_corrected)
+        loss_rec_e, r_no_sym, shifts, delta = self.decode_images_with_loss(images, images_corrected, *batch_params)
 
         if self.useHet:
             loss_rec_with_het = self.decode_images_het_with_loss(images, images_corrected,
@@ -981,8 +1229,8 @@ class AutoEncoder(Model):
         return return_dict
 
     def eval_volume(self, filter=True, het=None):
-        coords = tf.constant(self.generator.coords, dtype=tf.float32)[None, ...]
-        o = self.generator.indices[None, ...]
+        coords = self.coords[None, ...]
+        o = self.generator.indices
 
         # Delta volume
         if not self.only_pose and het is None:
@@ -994,28 +1242,23 @@ class AutoEncoder(Model):
         if self.useHet and het is not None:
             delta_het = self.het_decoder(het)
             num_vols = het.shape[0]
-            o = tf.tile(o, (num_vols, 1, 1))
         else:
             delta_het = 0.0
             num_vols = 1
 
         # Decode map
-        values = self.generator.values[None, ...] + delta + delta_het
-
-        # Create volume grid
-        volumes = tf.zeros((num_vols, self.generator.xsize, self.generator.xsize, self.generator.xsize),
-                           dtype=tf.float32)
+        values = self.values_bcast + delta + delta_het
 
         # Scatter in volumes
-        fn = lambda inp: tf.tensor_scatter_nd_add(inp[0], inp[1], inp[2])
-        volumes = tf.map_fn(fn, [volumes, o, values], fn_output_signature=tf.float32).numpy()
+        values = tf.broadcast_to(tf.cast(values, tf.float32), [num_vols, tf.shape(values)[-1]])
+        volumes = batch_scatter_nd(o, values, [self.generator.xsize, self.generator.xsize,
+                                               self.generator.xsize])
 
-        # Filter volumes
+        # Filter volumes (on device, before copying them to host)
         if filter:
-            for idx in range(num_vols):
-                volumes[idx] = gaussian_filter(volumes[idx], sigma=1)
+            volumes = separable_gaussian_filter_3d(volumes[..., None], self.volume_kernel)[..., 0]
 
-        return volumes
+        return volumes.numpy()
 
     def predict_step(self, data):
         self.generator.indexes = data[1]
@@ -1023,30 +1266,8 @@ class AutoEncoder(Model):
 
         images = data[0]
 
-        # Update batch_size (in case it is incomplete)
-        batch_size_scope = tf.shape(data[0])[0]
-
-        if self.generator.refinement:
-            # Precompute batch alignments
-            rot_batch = tf.gather(self.generator.angle_rot, data[1], axis=0)
-            tilt_batch = tf.gather(self.generator.angle_tilt, data[1], axis=0)
-            psi_batch = tf.gather(self.generator.angle_psi, data[1], axis=0)
-
-            # Precompute shifts
-            shifts_x = tf.gather(self.generator.shifts[0], data[1], axis=0)
-            shifts_y = tf.gather(self.generator.shifts[1], data[1], axis=0)
-            shifts_batch = tf.stack([shifts_x, shifts_y], axis=1)
-
-        # Precompute batch CTFs
-        defocusU_batch = tf.gather(self.generator.defocusU, data[1], axis=0)
-        defocusV_batch = tf.gather(self.generator.defocusV, data[1], axis=0)
-        defocusAngle_batch = tf.gather(self.generator.defocusAngle, data[1], axis=0)
-        cs_batch = tf.gather(self.generator.cs, data[1], axis=0)
-        kv_batch = self.generator.kv
-        ctf = computeCTF(defocusU_batch, defocusV_batch, defocusAngle_batch, cs_batch, kv_batch,
-                         self.generator.sr, self.generator.pad_factor,
-                         [self.generator.xsize, int(0.5 * self.generator.xsize + 1)],
-                         batch_size_scope, self.generator.applyCTF)
+        # Precompute batch alignments, shifts and CTFs
+        rot_batch, tilt_batch, psi_batch, shifts_batch, ctf = self.gather_batch(data[1])
         self.generator.ctf = ctf
 
         # Wiener filter
@@ -1056,7 +1277,7 @@ class AutoEncoder(Model):
             images_corrected = images
 
         # Original coordinates
-        o = tf.constant(self.generator.coords, dtype=tf.float32)[None, ...]
+        o = self.coords[None, ...]
 
         # Common encoder and volume decoder
         encoded = self.common_encoder(images_corrected)
@@ -1064,49 +1285,53 @@ class AutoEncoder(Model):
         # Consensus volume decoder
         if not self.only_pose:
             delta = self.decoder_delta(o)
+            values_cons = self.values_bcast + delta
         else:
             delta = 0.0
+            values_cons = self.values_bcast
 
         # Heterogeneous volume decoder
         if self.useHet:
             # het, rows_het, shifts_het = self.het_encoder(images_corrected)
             het = self.het_encoder(images_corrected)
             delta_het = self.het_decoder(het)
+            values = self.values_bcast + delta_het
         else:
             het = 0.0
             delta_het = 0.0
-
-        # Coordinates with batch dimension
-        o = self.generator.scale_factor * tf.tile(o, (batch_size_scope, 1, 1))
+            values = self.values_bcast
 
         # Prepare outputs
-        prev_loss_rec = 10000. * tf.ones(batch_size_scope, dtype=tf.float32)
-        prev_loss_rec_cons = 10000. * tf.ones(batch_size_scope, dtype=tf.float32)
-        keep_r = tf.zeros((batch_size_scope, 3, 3), dtype=tf.float32)
-        keep_shifts = tf.zeros((batch_size_scope, 2), dtype=tf.float32)
-        keep_imgs = tf.zeros((batch_size_scope, self.generator.xsize, self.generator.xsize), dtype=tf.float32)
-        keep_imgs_cons = tf.zeros((batch_size_scope, self.generator.xsize, self.generator.xsize), dtype=tf.float32)
-
-        # Multi-head encoders
-        for idr in range(self.n_candidates):
-            rows, shifts = self.head_encoder[idr](encoded)
+        losses_rec, losses_rec_cons, imgs_candidates = [], [], []
 
-            if self.generator.refinement:
-                shifts = shifts + shifts_batch
+        # Multi-head encoders (all candidate poses at once)
+        rows_candidates, shifts_candidates = self.head_encoder(encoded)
 
-            # if self.useHet:
-            #     shifts = shifts + shifts_het
+        # Rotation matrices of all the candidates at once (B, n_candidates, 3, 3)
+        rows_flat = tf.reshape(rows_candidates, [-1, rows_candidates.shape[-1]])
+        if self.useQuaternions:
+            r_candidates = quaternion_to_rotation_matrix(rows_flat)
+        else:
+            r_candidates = gramSchmidt(rows_flat)
+        r_candidates = tf.reshape(r_candidates, [-1, self.n_candidates, 3, 3])
 
-            # Get rotation matrices
-            if self.useQuaternions:
-                r = quaternion_to_rotation_matrix(rows)
-            else:
-                r = gramSchmidt(rows)
+        if self.generator.refinement:
+            shifts_candidates = shifts_candidates + shifts_batch[:, None, :]
+            r_o = euler_matrix_batch(rot_batch, tilt_batch, psi_batch)
+            r_o = tf.stack(r_o, axis=1)
+            r_candidates = tf.matmul(r_candidates, r_o[:, None])
 
-            if self.generator.refinement:
-                r_o = euler_matrix_batch(rot_batch, tilt_batch, psi_batch)
-                r_o = tf.stack(r_o, axis=1)
-                r = tf.matmul(r, r_o)
+        # Image origin minus the shifts of all the candidates (B, n_candidates, 2)
+        origin_candidates = self.generator.xmipp_origin[0] - shifts_candidates
+
+        # Batch CTFs with the Gaussian filter folded in (complex, shared by all the candidates)
+        ctf_filter = tf.cast(ctf * self.gaussian_transfer, tf.complex64) if self.applyCTF else None
+
+        for idr in range(self.n_candidates):
+            r = r_candidates[:, idr]
+
+            # if self.useHet:
+            #     shifts = shifts + shifts_het
 
             # if self.useHet:
             #     if self.useQuaternions:
@@ -1115,81 +1340,38 @@ class AutoEncoder(Model):
             #         r_het = gramSchmidt(rows_het)
             #     r = tf.matmul(r_het, r)
 
-            # Get rotated coords
-            ro = tf.matmul(o, tf.transpose(r, perm=[0, 2, 1]))
-
-            # Get XY coords
-            ro = ro[..., :-1]
+            # Get rotated XY coords (only the first two rows of r are needed)
+            ro = tf.einsum('nd,bed->bne', self.coords_scaled, r[..., :2, :])
 
             # Apply shifts
-            ro = ro - (shifts[:, None, :]) + self.generator.xmipp_origin[0]
-
-            # Permute coords
-            ro = tf.stack([ro[..., 1], ro[..., 0]], axis=-1)
-
-            # Initialize images
-            imgs_cons = tf.zeros((batch_size_scope, self.generator.xsize, self.generator.xsize), dtype=tf.float32)
-            imgs = tf.zeros((batch_size_scope, self.generator.xsize, self.generator.xsize), dtype=tf.float32)
-
-            # Image values
-            original_values = tf.tile(self.generator.values[None, :], (batch_size_scope, 1))
-            values_cons = original_values + delta
-            values = original_values + delta_het
-
-            # Backprop through coords
-            bpos_round = tf.round(ro)
-            bpos_flow = tf.cast(bpos_round, tf.int32)
-            num = tf.reduce_sum(((bpos_round - ro) ** 2.), axis=-1)
-            weight = tf.exp(-num / (2. * 1. ** 2.))
-            values_cons = values_cons * weight
-            values = values * weight
+            ro = ro + origin_candidates[:, idr, None, :]
 
             # Scatter images
-            fn = lambda inp: tf.tensor_scatter_nd_add(inp[0], inp[1], inp[2])
-            imgs_cons = tf.map_fn(fn, [imgs_cons, bpos_flow, values_cons], fn_output_signature=tf.float32)
-            imgs = tf.map_fn(fn, [imgs, bpos_flow, values], fn_output_signature=tf.float32)
+            imgs_cons = self.splat_images(ro, values_cons, self.generator.xsize)
+            imgs = self.splat_images(ro, values, self.generator.xsize)
 
-            # Reshape images
-            imgs_cons = tf.reshape(imgs_cons, [-1, self.xsize, self.xsize, 1])
-            imgs = tf.reshape(imgs, [-1, self.xsize, self.xsize, 1])
+            # Gaussian filtering and CTF corruption
+            imgs_cons = self.filter_projections(imgs_cons, ctf_filter)
+            imgs = self.filter_projections(imgs, ctf_filter)
 
-            # Gaussian filtering
-            imgs_cons = tfa.image.gaussian_filter2d(imgs_cons, 3, 1)
-            imgs = tfa.image.gaussian_filter2d(imgs, 3, 1)
+            # Image loss
+            losses_rec_cons.append(self.cost(images, imgs_cons))
+            losses_rec.append(self.cost(images, imgs))
+            imgs_candidates.append(imgs[..., 0])
 
-            # CTF corruption
-            if self.applyCTF:
-                imgs_cons = self.generator.ctfFilterImage(imgs_cons)
-                imgs = self.generator.ctfFilterImage(imgs)
+        # "Winner's takes it all" (candidate with the best consensus loss of each image)
+        losses_rec_cons = tf.stack(losses_rec_cons, axis=1)  # Shape: (B, n_candidates)
+        best = tf.argmin(losses_rec_cons, axis=1)
+        keep_r = tf.gather(r_candidates, best, batch_dims=1)
+        keep_shifts = tf.gather(shifts_candidates, best, batch_dims=1)
+        keep_imgs = tf.gather(tf.stack(imgs_candidates, axis=1), best, batch_dims=1)
+        loss_rec = tf.gather(tf.stack(losses_rec, axis=1), best, batch_dims=1)
+        loss_rec_cons = tf.reduce_min(losses_rec_cons, axis=1)
 
-            # Image loss
-            loss_rec_cons = self.cost(images, imgs_cons)
-            loss_rec = self.cost(images, imgs)
-
-            # Preparing indexing for "winner's takes it all"
-            # mask = tf.less_equal(loss_rec, prev_loss_rec)  # Shape: (B,)
-            mask = tf.less_equal(loss_rec_cons, prev_loss_rec_cons)  # Shape: (B,)
-            mask_shape_r = tf.concat([tf.shape(mask), tf.ones(2, dtype=tf.int32)], axis=0)
-            mask_shape_shifts = tf.concat([tf.shape(mask), tf.ones(1, dtype=tf.int32)], axis=0)
-            mask_shape_imgs_cons = tf.concat([tf.shape(mask), tf.ones(2, dtype=tf.int32)], axis=0)
-            mask_shape_imgs = tf.concat([tf.shape(mask), tf.ones(2, dtype=tf.int32)], axis=0)
-            mask_r = tf.reshape(mask, mask_shape_r)
-            mask_shifts = tf.reshape(mask, mask_shape_shifts)
-            mask_imgs_cons = tf.reshape(mask, mask_shape_imgs_cons)
-            mask_imgs = tf.reshape(mask, mask_shape_imgs)
-
-            # Minimum indexing
-            prev_loss_rec = tf.where(mask, loss_rec, prev_loss_rec)
-            prev_loss_rec_cons = tf.where(mask, loss_rec_cons, prev_loss_rec_cons)
-            keep_r = tf.where(mask_r, r, keep_r)
-            keep_shifts = tf.where(mask_shifts, shifts, keep_shifts)
-            keep_imgs_cons = tf.where(mask_imgs_cons, imgs_cons[..., 0], keep_imgs_cons)
-            keep_imgs = tf.where(mask_imgs, imgs[..., 0], keep_imgs)
-
-        return keep_r, keep_shifts, keep_imgs, het, prev_loss_rec, prev_loss_rec_cons
+        return keep_r, keep_shifts, keep_imgs, het, loss_rec, loss_rec_cons
 
     def call(self, input_features):
         # Original coordinates
-        o = tf.constant(self.generator.coords, dtype=tf.float32)[None, ...]
+        o = self.coords[None, ...]
         delta = self.decoder_delta(o)
         return delta
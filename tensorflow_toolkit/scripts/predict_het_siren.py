@@ -29,18 +29,18 @@
 import os
 import numpy as np
 from pathlib import Path
-from sklearn.cluster import KMeans
 from importlib.metadata import version
 from xmipp_metadata.image_handler import ImageHandler
-from threadpoolctl import threadpool_limits, threadpool_info
 
 if version("tensorflow") >= "2.16.0":
     os.environ["TF_USE_LEGACY_KERAS"] = "1"
 import tensorflow as tf
+from tensorflow.keras import mixed_precision
 from tensorboard.plugins import projector
 
 from tensorflow_toolkit.generators.generator_het_siren import Generator
 from tensorflow_toolkit.networks.het_siren import AutoEncoder
+from tensorflow_toolkit.utils import kmeans
 # from tensorflow_toolkit.datasets.dataset_template import sequence_to_data_pipeline, create_dataset
 
 from xmipp_metadata.metadata import XmippMetaData
@@ -54,11 +54,18 @@ from xmipp_metadata.metadata import XmippMetaData
 
 def predict(md_file, weigths_file, refinePose, architecture, ctfType, pad=2, sr=1.0,
             applyCTF=1, filter=False, only_pos=False, hetDim=10, numVol=20, trainSize=None, outSize=None,
-            poseReg=0.0, ctfReg=0.0, use_hyper_network=True):
+            poseReg=0.0, ctfReg=0.0, use_hyper_network=True, precision="float32",
+            jit_compile=False, batch_size=64):
+    # Inference can run the dense layers in half precision (weights are kept in float32)
+    assert precision in ["float32", "mixed_float16", "mixed_bfloat16"]
+    mixed_precision.set_global_policy(precision)
+    precision = {"float32": tf.float32, "mixed_float16": tf.float16, "mixed_bfloat16": tf.bfloat16}[precision]
+    precision_scaled = tf.float32 if os.environ.get("TF_USE_LEGACY_KERAS", "0") == "1" else precision
+
     # Create data generator
-    generator = Generator(md_file=md_file, shuffle=False, batch_size=16,
+    generator = Generator(md_file=md_file, shuffle=False, batch_size=batch_size,
                           step=1, splitTrain=1.0, pad_factor=pad, sr=sr,
-                          applyCTF=applyCTF, xsize=outSize)
+                          applyCTF=applyCTF, xsize=outSize, precision=precision)
 
     # Tensorflow data pipeline
     # generator_dataset, generator = sequence_to_data_pipeline(generator)
@@ -67,9 +74,11 @@ def predict(md_file, weigths_file, refinePose, architecture, ctfType, pad=2, sr=
     # Load model
     autoencoder = AutoEncoder(generator, architecture=architecture, CTF=ctfType, refPose=refinePose,
                               het_dim=hetDim, train_size=trainSize, only_pos=True, poseReg=poseReg, ctfReg=ctfReg,
-                              use_hyper_network=use_hyper_network)
+                              use_hyper_network=use_hyper_network, precision=precision,
+                              precision_scaled=precision_scaled)
     _ = autoencoder(next(iter(generator.return_tf_dataset()))[0])
     autoencoder.load_weights(weigths_file)
+    autoencoder.compile(jit_compile=jit_compile)
 
     # Metadata
     metadata = XmippMetaData(md_file)
@@ -81,14 +90,8 @@ def predict(md_file, weigths_file, refinePose, architecture, ctfType, pad=2, sr=
     elif generator.mode == "tomo":
         alignment, shifts, _, het = autoencoder.predict(generator.return_tf_dataset(), predict_mode="het")
 
-    # Get map
-    pool_info = threadpool_info()
-    with threadpool_limits(limits=1, user_api=pool_info[1]["user_api"]):
-        kmeans = KMeans(n_clusters=numVol).fit(het)
-    centers = kmeans.cluster_centers_
-    print("------------------ Decoding volume... ------------------")
-    decoded_maps = autoencoder.eval_volume_het(centers, filter=filter, only_pos=only_pos, allCoords=True,
-                                               add_to_original=True)
+    # Get map (clustering of the latent space on device)
+    centers = kmeans(het, numVol)
 
     # Tensorboard projector
     log_dir = os.path.join(os.path.dirname(md_file), "network", "logs")
@@ -116,7 +119,10 @@ def predict(md_file, weigths_file, refinePose, architecture, ctfType, pad=2, sr=
 
     metadata.write(md_file, overwrite=True)
 
-    # Save map
+    # Decode and save maps (written as soon as they are decoded)
+    print("------------------ Decoding volume... ------------------")
+    decoded_maps = autoencoder.iter_volumes_het(centers, filter=filter, only_pos=only_pos, allCoords=True,
+                                                add_to_original=True)
     for idx, decoded_map in enumerate(decoded_maps):
         decoded_path = Path(Path(md_file).parent, 'decoded_map_class_%02d.mrc' % (idx + 1))
         ImageHandler().write(decoded_map, decoded_path, overwrite=True)
@@ -144,6 +150,9 @@ def main():
     parser.add_argument('--trainSize', type=int, required=True)
     parser.add_argument('--outSize', type=int, required=True)
     parser.add_argument('--use_hyper_network', action='store_true')
+    parser.add_argument('--precision', type=str, required=False, default="float32")
+    parser.add_argument('--jit_compile', action='store_true')
+    parser.add_argument('--batch_size', type=int, required=False, default=64)
     parser.add_argument('--gpu', type=str)
 
     args = parser.parse_args()
@@ -160,7 +169,8 @@ def main():
               "applyCTF": args.apply_ctf, "filter": args.apply_filter,
               "only_pos": args.only_pos, "hetDim": args.het_dim, "numVol": args.num_vol,
               "trainSize": args.trainSize, "outSize": args.outSize, "poseReg": args.pose_reg, "ctfReg": args.ctf_reg,
-              "use_hyper_network": args.use_hyper_network}
+              "use_hyper_network": args.use_hyper_network, "precision": args.precision,
+              "jit_compile": args.jit_compile, "batch_size": args.batch_size}
 
     # Initialize volume slicer
     predict(**inputs)
@@ -76,7 +76,7 @@ def predict(weigths_file, het_file, out_path, allCoords=False, filter=True, arch
     autoencoder.load_weights(weigths_file)
 
     # Decode maps
-    decoded_maps = autoencoder.eval_volume_het(x_het, allCoords=allCoords, filter=filter, add_to_original=True)
+    decoded_maps = autoencoder.iter_volumes_het(x_het, allCoords=allCoords, filter=filter, add_to_original=True)
     for idx, decoded_map in enumerate(decoded_maps):
         decoded_path = Path(out_path, 'decoded_map_class_%02d.mrc' % (idx + 1))
         ImageHandler().write(decoded_map, decoded_path, overwrite=True)
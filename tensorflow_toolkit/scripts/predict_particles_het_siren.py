@@ -53,7 +53,7 @@ from tensorflow_toolkit.networks.het_siren import AutoEncoder
 
 def predict(md_file, weigths_file, refinePose, architecture, ctfType,
             pad=2, sr=1.0, applyCTF=1, hetDim=10, trainSize=None, outSize=None, addCTF=False,
-            poseReg=0.0, ctfReg=0.0):
+            poseReg=0.0, ctfReg=0.0, jit_compile=False):
     # Create data generator
     generator = Generator(md_file=md_file, shuffle=False, batch_size=16,
                           step=1, splitTrain=1.0, pad_factor=pad, sr=sr,
@@ -68,6 +68,7 @@ def predict(md_file, weigths_file, refinePose, architecture, ctfType,
                               het_dim=hetDim, train_size=trainSize, poseReg=poseReg, ctfReg=ctfReg)
     _ = autoencoder(next(iter(generator.return_tf_dataset()))[0])
     autoencoder.load_weights(weigths_file)
+    autoencoder.compile(jit_compile=jit_compile)
 
     # Metadata
     metadata = XmippMetaData(md_file)
@@ -83,11 +84,14 @@ def predict(md_file, weigths_file, refinePose, architecture, ctfType,
                            mrc_mode=2, overwrite=True)
     autoencoder.predict_mode = "particles" if not addCTF else "particles_ctf"
     autoencoder.applyCTF = 0 if not addCTF else 1
+    predict_step = tf.function(jit_compile=jit_compile)(autoencoder.predict_step)
     idx = 0
-    for data in tqdm.tqdm(generator, file=sys.stdout):
+    for data in tqdm.tqdm(generator.return_tf_dataset(), file=sys.stdout):
         idx_init = idx * generator.batch_size
         idx_end = idx_init + generator.batch_size
-        particles = np.squeeze(autoencoder.predict_step(data))
+        # Reuse the poses and latent codes predicted above instead of encoding the batch again
+        latents = (alignment[idx_init:idx_end], shifts[idx_init:idx_end], het[idx_init:idx_end])
+        particles = np.squeeze(predict_step((data[0], data[1], latents)))
         mrc.data[idx_init:idx_end] = np.squeeze(particles)
         idx += 1
     mrc.close()
@@ -134,6 +138,7 @@ def main():
     parser.add_argument('--addCTF', action='store_true')
     parser.add_argument('--pose_reg', type=float, required=False, default=0.0)
     parser.add_argument('--ctf_reg', type=float, required=False, default=0.0)
+    parser.add_argument('--jit_compile', action='store_true')
     parser.add_argument('--gpu', type=str)
 
     args = parser.parse_args()
@@ -149,7 +154,8 @@ def main():
               "ctfType": args.ctf_type, "pad": args.pad, "sr": args.sr,
               "applyCTF": args.apply_ctf, "hetDim": args.het_dim,
               "trainSize": args.trainSize, "outSize": args.outSize,
-              "addCTF": args.addCTF, "poseReg": args.pose_reg, "ctfReg": args.ctf_reg}
+              "addCTF": args.addCTF, "poseReg": args.pose_reg, "ctfReg": args.ctf_reg,
+              "jit_compile": args.jit_compile}
 
     # Initialize volume slicer
     predict(**inputs)
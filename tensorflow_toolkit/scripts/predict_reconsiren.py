@@ -36,6 +36,7 @@ from xmipp_metadata.metadata import XmippMetaData
 
 os.environ["TF_USE_LEGACY_KERAS"] = "0"
 import tensorflow as tf
+from tensorflow.keras import mixed_precision
 
 from tensorflow_toolkit.generators.generator_reconsiren import Generator
 from tensorflow_toolkit.networks.reconsiren import AutoEncoder
@@ -43,7 +44,12 @@ from tensorflow_toolkit.utils import xmippEulerFromMatrix
 
 
 def predict(md_file, weigths_file, architecture, ctfType, pad=2, sr=1.0, n_candidates=6,
-            applyCTF=1, filter=True, only_pose=False, only_pos=False, useHet=False):
+            applyCTF=1, filter=True, only_pose=False, only_pos=False, useHet=False, precision="float32",
+            cache_ctf=False, fourier_resize=False, bilinear_splat=False):
+    # Encoders and decoders may run in reduced precision (projections and losses are kept in float32)
+    assert precision in ["float32", "mixed_float16", "mixed_bfloat16"]
+    mixed_precision.set_global_policy(precision)
+
     # Create data generator
     generator = Generator(md_file=md_file, shuffle=False, batch_size=32,
                           step=1, splitTrain=1.0, cost="mse", pad_factor=pad, sr=sr,
@@ -53,7 +59,8 @@ def predict(md_file, weigths_file, architecture, ctfType, pad=2, sr=1.0, n_candi
     autoencoder = AutoEncoder(generator, architecture=architecture, CTF=None,
                               l1_lambda=0.0, tv_lambda=0.0, mse_lambda=0.0, un_lambda=0.0001,
                               ud_lambda=0.000001, only_pose=only_pose, n_candidates=n_candidates,
-                              only_pos=only_pos, useHet=useHet)
+                              only_pos=only_pos, useHet=useHet, cache_ctf=cache_ctf,
+                              fourier_resize=fourier_resize, bilinear_splat=bilinear_splat)
     _ = autoencoder(next(iter(generator.return_tf_dataset()))[0])
     autoencoder.load_weights(weigths_file)
 
@@ -124,6 +131,10 @@ def main():
     parser.add_argument('--only_pos', action='store_true')
     parser.add_argument('--heterogeneous', action='store_true')
     parser.add_argument('--n_candidates', type=int, required=True)
+    parser.add_argument('--precision', type=str, required=False, default="float32")
+    parser.add_argument('--cache_ctf', action='store_true')
+    parser.add_argument('--fourier_resize', action='store_true')
+    parser.add_argument('--bilinear_splat', action='store_true')
     parser.add_argument('--gpu', type=str)
 
     args = parser.parse_args()
@@ -138,7 +149,8 @@ def main():
               "architecture": args.architecture, "ctfType": None, "pad": args.pad, "sr": args.sr,
               "applyCTF": 0, "filter": args.apply_filter,
               "only_pose": args.only_pose, "only_pos": args.only_pos, "n_candidates": args.n_candidates,
-              "useHet": args.heterogeneous}
+              "useHet": args.heterogeneous, "precision": args.precision, "cache_ctf": args.cache_ctf,
+              "fourier_resize": args.fourier_resize, "bilinear_splat": args.bilinear_splat}
 
     # Initialize volume slicer
     predict(**inputs)
@@ -52,12 +52,13 @@ def train(outPath, md_file, batch_size, shuffle, step, splitTrain, epochs, cost,
           radius_mask, smooth_mask, refinePose, architecture="convnn", weigths_file=None,
           ctfType="apply", pad=2, sr=1.0, applyCTF=1, hetDim=10, l1Reg=0.5, tvReg=0.1, mseReg=0.1, poseReg=0.0,
           ctfReg=0.0, lr=1e-5, only_pos=False, multires=None, jit_compile=True, trainSize=None, outSize=None,
-          tensorboard=True, useMirrorStrategy=False, use_hyper_network=True, precision="mixed_float16"):
+          tensorboard=True, useMirrorStrategy=False, use_hyper_network=True, precision="mixed_float16",
+          grad_accum_steps=1):
     # We need to import network and generators here instead of at the beginning of the script to allow Tensorflow
     # get the right GPUs set in CUDA_VISIBLE_DEVICES
-    assert precision in ["float32", "mixed_float16"]
+    assert precision in ["float32", "mixed_float16", "mixed_bfloat16"]
     mixed_precision.set_global_policy(precision)
-    precision = tf.float32 if precision == "float32" else tf.float16
+    precision = {"float32": tf.float32, "mixed_float16": tf.float16, "mixed_bfloat16": tf.bfloat16}[precision]
     precision_scaled = tf.float32 if os.environ["TF_USE_LEGACY_KERAS"] == "1" else precision
     from tensorflow_toolkit.generators.generator_het_siren import Generator
     from tensorflow_toolkit.networks.het_siren import AutoEncoder
@@ -95,7 +96,8 @@ def train(outPath, md_file, batch_size, shuffle, step, splitTrain, epochs, cost,
                                       het_dim=hetDim, l1_lambda=l1Reg, tv_lambda=tvReg, mse_lambda=mseReg,
                                       train_size=trainSize, only_pos=only_pos, multires_levels=multires,
                                       poseReg=poseReg, ctfReg=ctfReg, precision=precision,
-                                      precision_scaled=precision_scaled, use_hyper_network=use_hyper_network)
+                                      precision_scaled=precision_scaled, use_hyper_network=use_hyper_network,
+                                      grad_accum_steps=grad_accum_steps)
 
             # Fine tune a previous model
             if weigths_file:
@@ -147,6 +149,10 @@ def train(outPath, md_file, batch_size, shuffle, step, splitTrain, epochs, cost,
                     latest = os.path.basename(latest)
                     initial_epoch = int(re.findall(r'\d+', latest)[0]) - 1
 
+            # Gradient accumulators are created when compiling, so the model has to be built first
+            if grad_accum_steps > 1 and not autoencoder.built:
+                _ = autoencoder(next(iter(generator.return_tf_dataset()))[0])
+
             autoencoder.compile(optimizer=optimizer, jit_compile=jit_compile)
 
             if generator_val is not None:
@@ -208,6 +214,8 @@ def main():
     parser.add_argument('--outSize', type=int, required=True)
     parser.add_argument('--apply_ctf', type=int, required=True)
     parser.add_argument('--jit_compile', action='store_true')
+    parser.add_argument('--precision', type=str, required=False, default="mixed_float16")
+    parser.add_argument('--grad_accum_steps', type=int, required=False, default=1)
     parser.add_argument('--tensorboard', action='store_true')
     parser.add_argument('--gpu', type=str)
 
@@ -241,7 +249,8 @@ def main():
               "multires": args.multires, "jit_compile": args.jit_compile,
               "trainSize": args.trainSize, "outSize": args.outSize, "tensorboard": args.tensorboard,
               "only_pos": args.only_pos, "useMirrorStrategy": useMirrorStrategy,
-              "use_hyper_network": args.use_hyper_network}
+              "use_hyper_network": args.use_hyper_network, "precision": args.precision,
+              "grad_accum_steps": args.grad_accum_steps}
 
     # Initialize volume slicer
     train(**inputs)
@@ -42,7 +42,7 @@ os.environ["TF_USE_LEGACY_KERAS"] = "0"
 # if version("tensorflow") >= "2.16.0":
 #     os.environ["TF_USE_LEGACY_KERAS"] = "1"
 import tensorflow as tf
-# from tensorflow.keras import mixed_precision
+from tensorflow.keras import mixed_precision
 
 from tensorflow_toolkit.utils import epochs_from_iterations, xmippEulerFromMatrix
 
@@ -50,9 +50,15 @@ from tensorflow_toolkit.utils import epochs_from_iterations, xmippEulerFromMatri
 def train(outPath, md_file, batch_size, shuffle, splitTrain, epochs, only_pose=False, n_candidates=6,
           architecture="convnn", weigths_file=None, ctfType=None, pad=4, sr=1.0, applyCTF=0, l1Reg=0.5,
           tvReg=0.1, mseReg=0.1, udLambda=0.000001, unLambda=0.0001, only_pos=False, useHet=False,
-          jit_compile=True, tensorboard=True):
+          jit_compile=True, tensorboard=True, precision="float32", cache_ctf=False, fourier_resize=False,
+          bilinear_splat=False):
     # We need to import network and generators here instead of at the beginning of the script to allow Tensorflow
     # get the right GPUs set in CUDA_VISIBLE_DEVICES
+    # Encoders and decoders may run in reduced precision (projections and losses are kept in float32). The
+    # optimizers are not wrapped in a LossScaleOptimizer, so mixed_float16 is opt-in (mixed_bfloat16 does not
+    # need loss scaling)
+    assert precision in ["float32", "mixed_float16", "mixed_bfloat16"]
+    mixed_precision.set_global_policy(precision)
     from tensorflow_toolkit.generators.generator_reconsiren import Generator
     from tensorflow_toolkit.networks.reconsiren import AutoEncoder
 
@@ -80,7 +86,8 @@ def train(outPath, md_file, batch_size, shuffle, splitTrain, epochs, only_pose=F
             autoencoder = AutoEncoder(generator, architecture=architecture, CTF=None,
                                       l1_lambda=l1Reg, tv_lambda=tvReg, mse_lambda=mseReg, un_lambda=unLambda,
                                       ud_lambda=udLambda, only_pose=only_pose, n_candidates=n_candidates,
-                                      only_pos=only_pos, multires=None, useHet=useHet)
+                                      only_pos=only_pos, multires=None, useHet=useHet, cache_ctf=cache_ctf,
+                                      fourier_resize=fourier_resize, bilinear_splat=bilinear_splat)
 
             # Fine tune a previous model
             if weigths_file:
@@ -250,7 +257,11 @@ def main():
     parser.add_argument('--sr', type=float, required=True)
     # parser.add_argument('--apply_ctf', type=int, required=True)
     parser.add_argument('--jit_compile', action='store_true')
+    parser.add_argument('--precision', type=str, required=False, default="float32")
     parser.add_argument('--tensorboard', action='store_true')
+    parser.add_argument('--cache_ctf', action='store_true')
+    parser.add_argument('--fourier_resize', action='store_true')
+    parser.add_argument('--bilinear_splat', action='store_true')
     parser.add_argument('--gpu', type=str)
 
     args = parser.parse_args()
@@ -277,9 +288,10 @@ def main():
               "pad": args.pad, "sr": args.sr, "applyCTF": 0,
               "l1Reg": args.l1_reg, "tvReg": args.tv_reg, "mseReg": args.mse_reg,
               "udLambda": args.ud_lambda, "unLambda": args.un_lambda,
-              "jit_compile": args.jit_compile, "tensorboard": args.tensorboard,
+              "jit_compile": args.jit_compile, "tensorboard": args.tensorboard, "precision": args.precision,
               "only_pose": args.only_pose, "only_pos": args.only_pos, "n_candidates": args.n_candidates,
-              "useHet": args.heterogeneous}
+              "useHet": args.heterogeneous, "cache_ctf": args.cache_ctf,
+              "fourier_resize": args.fourier_resize, "bilinear_splat": args.bilinear_splat}
 
     # Initialize volume slicer
     train(**inputs)
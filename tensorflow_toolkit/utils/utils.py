@@ -26,6 +26,7 @@
 
 
 import math
+import h5py
 import numpy as np
 import scipy.stats as st
 
@@ -390,3 +391,76 @@ def apply_blur_filters_to_batch(images, filters):
     # Apply the filters
     blurred_images = tf.nn.depthwise_conv2d(images, filters, strides=[1, 1, 1, 1], padding='SAME')
     return blurred_images
+
+@tf.function
+def _kmeans_centers(data, n_clusters, max_iter, tol):
+    # Squared distances of all the points to a set of centers (N, K)
+    data_sq = tf.reduce_sum(tf.square(data), axis=1, keepdims=True)
+    sq_dist = lambda centers: (data_sq - 2. * tf.matmul(data, centers, transpose_b=True)
+                               + tf.reduce_sum(tf.square(centers), axis=1)[None, :])
+
+    # K-means++ initialization
+    first = tf.random.uniform([], 0, tf.shape(data)[0], dtype=tf.int32)
+    centers = tf.gather(data, first)[None, :]
+    min_dist = tf.maximum(sq_dist(centers)[:, 0], 0.)
+    for _ in range(n_clusters - 1):
+        idx = tf.random.categorical(tf.math.log(min_dist + 1e-12)[None, :], 1)[0, 0]
+        new_center = tf.gather(data, idx)[None, :]
+        centers = tf.concat([centers, new_center], axis=0)
+        min_dist = tf.minimum(min_dist, tf.maximum(sq_dist(new_center)[:, 0], 0.))
+
+    # Lloyd iterations (empty clusters keep their previous center)
+    tol = tol * tf.reduce_mean(tf.math.reduce_variance(data, axis=0))
+    for _ in tf.range(max_iter):
+        labels = tf.argmin(sq_dist(centers), axis=1, output_type=tf.int32)
+        counts = tf.math.unsorted_segment_sum(tf.ones_like(labels), labels, n_clusters)
+        new_centers = tf.math.unsorted_segment_mean(data, labels, n_clusters)
+        new_centers = tf.where(counts[:, None] > 0, new_centers, centers)
+        center_shift = tf.reduce_sum(tf.square(new_centers - centers))
+        centers = new_centers
+        if center_shift <= tol:
+            break
+
+    return centers
+
+def kmeans(data, n_clusters, max_iter=300, tol=1e-4):
+    """
+    K-means clustering (k-means++ initialization followed by Lloyd iterations) computed with TensorFlow,
+    so it runs on the GPU when available.
+
+    Args:
+    - data: Points to cluster with shape (n_samples, n_features).
+    - n_clusters: The number of clusters.
+    - max_iter: Maximum number of Lloyd iterations.
+    - tol: Convergence tolerance on the squared shift of the centers (relative to the data variance).
+
+    Returns:
+    - A numpy array with the cluster centers, with shape (n_clusters, n_features).
+    """
+    data = tf.cast(data, tf.float32)
+    return _kmeans_centers(data, n_clusters, max_iter, tol).numpy()
+
+def read_h5_weights(weights_file):
+    """
+    Read the weights stored in a (legacy format) Keras HDF5 weights file.
+
+    Args:
+    - weights_file: Path to the HDF5 file written by Model.save_weights.
+
+    Returns:
+    - A list with the weight arrays of each saved layer (layers without weights are skipped), in the order
+      they were saved.
+    """
+    def decode(names):
+        return [name.decode("utf8") if isinstance(name, bytes) else name for name in names]
+
+    with h5py.File(weights_file, "r") as f:
+        if "layer_names" not in f.attrs:
+            raise ValueError("%s is not a Keras HDF5 weights file" % weights_file)
+        layer_weights = []
+        for layer_name in decode(f.attrs["layer_names"]):
+            group = f[layer_name]
+            weight_names = decode(group.attrs["weight_names"])
+            if weight_names:
+                layer_weights.append([np.asarray(group[weight_name]) for weight_name in weight_names])
+    return layer_weights
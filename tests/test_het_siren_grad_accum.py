@@ -0,0 +1,77 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("xmipp_metadata")
+het_siren = pytest.importorskip("tensorflow_toolkit.networks.het_siren")
+
+AutoEncoder = het_siren.AutoEncoder
+
+
+class AccumModel(tf.keras.Model):
+    # Minimal model sharing the HetSIREN gradient accumulation (the full AutoEncoder needs a dataset on disk)
+    build_grad_accum = AutoEncoder.build_grad_accum
+    accumulate_gradients = AutoEncoder.accumulate_gradients
+
+    def __init__(self, grad_accum_steps):
+        super(AccumModel, self).__init__()
+        self.dense = tf.keras.layers.Dense(1)
+        self.grad_accum_steps = grad_accum_steps
+
+    def call(self, x):
+        return self.dense(x)
+
+    def compile(self, *args, **kwargs):
+        super(AccumModel, self).compile(*args, **kwargs)
+        self.build_grad_accum()
+
+    def train_step(self, data):
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_mean(tf.square(self(data) - 1.0))
+        grads = tape.gradient(loss, self.trainable_weights)
+        self.accumulate_gradients(grads)
+        return {"loss": loss}
+
+
+class WeightsHistory(tf.keras.callbacks.Callback):
+    def on_train_begin(self, logs=None):
+        self.history = [[weight.numpy() for weight in self.model.trainable_weights]]
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.history.append([weight.numpy() for weight in self.model.trainable_weights])
+
+
+def changed(before, after):
+    return any(not np.array_equal(b, a) for b, a in zip(before, after))
+
+
+def build_model(grad_accum_steps=2):
+    model = AccumModel(grad_accum_steps=grad_accum_steps)
+    _ = model(np.zeros((1, 3), dtype=np.float32))
+    model.compile(optimizer=tf.keras.optimizers.SGD(learning_rate=0.1))
+    return model
+
+
+def test_weights_only_change_every_grad_accum_steps():
+    model = build_model()
+    data = np.random.default_rng(0).normal(size=(6 * 4, 3)).astype(np.float32)
+
+    history = WeightsHistory()
+    model.fit(tf.data.Dataset.from_tensor_slices(data).batch(4), epochs=1, callbacks=[history], verbose=0)
+
+    steps_changed = [changed(before, after) for before, after in zip(history.history[:-1], history.history[1:])]
+    assert steps_changed == [False, True] * 3
+    assert model.grad_accum.step.numpy() == 0
+
+
+def test_accumulators_are_not_saved_with_the_weights(tmp_path):
+    h5py = pytest.importorskip("h5py")
+    model = build_model()
+    assert len(model.weights) == 2
+
+    weights_file = str(tmp_path / "accum_model.weights.h5")
+    model.save_weights(weights_file)
+    datasets = []
+    with h5py.File(weights_file, "r") as f:
+        f.visititems(lambda name, obj: datasets.append(name) if isinstance(obj, h5py.Dataset) else None)
+    assert len(datasets) == 2
@@ -0,0 +1,38 @@
+from types import MethodType, SimpleNamespace
+
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+reconsiren = pytest.importorskip("tensorflow_toolkit.networks.reconsiren")
+
+AutoEncoder = reconsiren.AutoEncoder
+
+
+def make_autoencoder(num_particles=11, xsize=16):
+    rng = np.random.default_rng(0)
+    batch_params = np.zeros((num_particles, 9), dtype=np.float32)
+    batch_params[:, :5] = rng.uniform(-10., 10., (num_particles, 5))
+    batch_params[:, 5] = rng.uniform(5000., 20000., num_particles)  # defocusU
+    batch_params[:, 6] = batch_params[:, 5] + rng.uniform(0., 500., num_particles)  # defocusV
+    batch_params[:, 7] = rng.uniform(0., 180., num_particles)  # defocusAngle
+    batch_params[:, 8] = 2.7  # cs
+
+    generator = SimpleNamespace(kv=300., sr=1.0, pad_factor=2, xsize=xsize, applyCTF=1)
+    autoencoder = SimpleNamespace(generator=generator, batch_params=tf.constant(batch_params), ctf_table=None)
+    for name in ["compute_ctf", "build_ctf_table", "gather_batch"]:
+        setattr(autoencoder, name, MethodType(getattr(AutoEncoder, name), autoencoder))
+    return autoencoder
+
+
+@pytest.mark.parametrize("indexes", [[3, 0, 7, 10, 5], [9, 1, 4, 2], [6]])
+def test_cached_ctf_matches_computed_ctf(indexes):
+    autoencoder = make_autoencoder()
+    indexes = tf.constant(indexes, dtype=tf.int32)
+    expected = autoencoder.gather_batch(indexes)[-1]
+
+    # Chunk size not dividing the number of particles to exercise the per chunk unshift
+    autoencoder.ctf_table = autoencoder.build_ctf_table(chunk_size=3)
+    cached = autoencoder.gather_batch(indexes)[-1]
+
+    np.testing.assert_allclose(cached.numpy(), expected.numpy(), atol=2e-3)
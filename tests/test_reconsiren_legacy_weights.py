@@ -0,0 +1,102 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+reconsiren = pytest.importorskip("tensorflow_toolkit.networks.reconsiren")
+
+from tensorflow.keras import layers, Input, Model
+
+from tensorflow_toolkit.layers.siren import Sine, SIRENFirstLayerInitializer, SIRENInitializer
+
+if not getattr(tf.keras, "__version__", "2").startswith("2."):
+    pytest.skip("Legacy HDF5 weights are only written by Keras 2", allow_module_level=True)
+
+
+class OldHeadEncoder(Model):
+    # Pose head layout saved before the heads were grouped (one model per candidate, unpadded outputs)
+    def __init__(self, useQuaternions=False):
+        super(OldHeadEncoder, self).__init__()
+        x = Input(shape=(1024,))
+
+        rows = layers.Dense(1024, activation="relu")(x)
+        for _ in range(3):
+            rows = layers.Dense(1024, activation="relu")(rows)
+        if useQuaternions:
+            rows = layers.Dense(4, activation="linear")(rows)
+            rows = reconsiren.QuaternionLayer()(rows)
+        else:
+            rows = layers.Dense(6, activation="linear")(rows)
+
+        shifts = layers.Dense(1024, activation="relu")(x)
+        for _ in range(3):
+            shifts = layers.Dense(1024, activation="relu")(shifts)
+        shifts = layers.Dense(2, activation="linear")(shifts)
+
+        self.encoder = tf.keras.Model(x, [rows, shifts])
+
+    def call(self, x):
+        return self.encoder(x)
+
+
+class OldDecoder(Model):
+    # Consensus decoder layout saved before the output layer was padded
+    def __init__(self, total_voxels):
+        super(OldDecoder, self).__init__()
+        coords = Input(shape=(total_voxels, 3,))
+        delta_vol = layers.Flatten()(coords)
+        delta_vol = layers.Dense(10, activation=Sine(w0=1.0),
+                                 kernel_initializer=SIRENFirstLayerInitializer(scale=1.0))(delta_vol)
+        for _ in range(3):
+            delta_vol = layers.Dense(10, activation=Sine(w0=1.0),
+                                     kernel_initializer=SIRENInitializer(c=1.0))(delta_vol)
+        delta_vol = layers.Dense(total_voxels, activation='linear')(delta_vol)
+        self.decoder = tf.keras.Model(coords, delta_vol)
+
+    def call(self, x):
+        return self.decoder(x)
+
+
+class OldAutoEncoder(Model):
+    def __init__(self, total_voxels, n_candidates, useQuaternions=False):
+        super(OldAutoEncoder, self).__init__()
+        self.head_encoder = [OldHeadEncoder(useQuaternions=useQuaternions) for _ in range(n_candidates)]
+        self.decoder_delta = OldDecoder(total_voxels)
+
+    def call(self, inputs):
+        features, coords = inputs
+        return [head(features) for head in self.head_encoder], self.decoder_delta(coords)
+
+
+def new_autoencoder(total_voxels, n_candidates, useQuaternions=False):
+    # Only the pose heads and the consensus decoder (the full AutoEncoder needs a dataset on disk)
+    autoencoder = reconsiren.AutoEncoder.__new__(reconsiren.AutoEncoder)
+    Model.__init__(autoencoder)
+    autoencoder.head_encoder = reconsiren.HeadEncoder(n_candidates=n_candidates, useQuaternions=useQuaternions)
+    autoencoder.decoder_delta = reconsiren.Decoder(total_voxels, only_pos=False)
+    autoencoder.n_candidates = n_candidates
+    return autoencoder
+
+
+@pytest.mark.parametrize("useQuaternions", [False, True])
+def test_old_weights_load_into_grouped_heads(tmp_path, useQuaternions):
+    total_voxels, n_candidates = 13, 2
+    rng = np.random.default_rng(0)
+    features = rng.normal(size=(4, 1024)).astype(np.float32)
+    coords = rng.uniform(-1., 1., size=(1, total_voxels, 3)).astype(np.float32)
+
+    old = OldAutoEncoder(total_voxels, n_candidates, useQuaternions=useQuaternions)
+    old_heads, old_decoded = old((features, coords))
+    weights_file = str(tmp_path / "reconsiren_model.h5")
+    old.save_weights(weights_file)
+
+    autoencoder = new_autoencoder(total_voxels, n_candidates, useQuaternions=useQuaternions)
+    _ = autoencoder.head_encoder(features)
+    _ = autoencoder.decoder_delta(coords)
+    autoencoder.built = True
+    autoencoder.load_weights(weights_file)
+
+    rows, shifts = autoencoder.head_encoder(features)
+    for idx, (old_rows, old_shifts) in enumerate(old_heads):
+        np.testing.assert_allclose(rows[:, idx].numpy(), old_rows.numpy(), rtol=1e-4, atol=1e-5)
+        np.testing.assert_allclose(shifts[:, idx].numpy(), old_shifts.numpy(), rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(autoencoder.decoder_delta(coords).numpy(), old_decoded.numpy(), rtol=1e-4, atol=1e-5)